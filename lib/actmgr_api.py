@@ -1,77 +1,343 @@
+import hashlib
 import json
 import logging
+import os
+import random
 import requests
 import sys
+import threading
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from urlparse import urljoin
 
 logger = logging.getLogger()
 
-def get_status(url, headers, name = 'CLOSED'):
+CA_BUNDLE = "/etc/pki/tls/certs/ca-bundle.crt"
+# Pages requested ahead of the page being read
+PAGE_WINDOW = 4
+# Seconds a cached status is used without asking the server, statuses do not change
+STATUS_TTL = 86400
+# Connections kept alive by the shared session
+POOL_SIZE = 10
+# Concurrent requests of update_accounts
+UPDATE_JOBS = 4
+# Seconds to wait for the server to respond to a request
+REQUEST_TIMEOUT = 30
+# Retries of an update that timed out or got a 5xx or 429 response
+UPDATE_RETRIES = 5
+# Seconds before the first retry, doubled for each retry up to BACKOFF_MAX
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """requests.Session shared by all API calls, keeping connections alive between requests"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            _session.mount("http://", _adapter)
+            _session.mount("https://", _adapter)
+        return _session
+
+
+class ResponseCache(object):
+    """On-disk cache of API GET responses keyed by URL and parameters
+
+    Responses younger than ttl seconds are used without a request.  Older ones
+    are revalidated with If-None-Match and If-Modified-Since when the server
+    sent an ETag or Last-Modified, a 304 response keeps using them.  All pages
+    of a paginated listing are cached together by get_pages.  Files are only
+    readable by their owner as they contain account data.
+    """
+    def __init__(self, directory, ttl=300):
+        self.directory = directory
+        self.ttl = ttl
+
+    def path(self, url, params):
+        _key = "%s?%s" % (url, json.dumps(params or {}, sort_keys=True))
+        return os.path.join(self.directory, hashlib.sha1(_key).hexdigest() + ".json")
+
+    def load(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def write(self, path, entry):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory, 0700)
+            except OSError:
+                # Created by another thread
+                if not os.path.isdir(self.directory):
+                    raise
+        _tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        with os.fdopen(os.open(_tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w') as f:
+            json.dump(entry, f)
+        os.rename(_tmp_path, path)
+
+    def response_entry(self, response):
+        return {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "data": response.json(),
+        }
+
+    def save(self, path, response):
+        _entry = self.response_entry(response)
+        self.write(path, _entry)
+        return _entry["data"]
+
+    def is_fresh(self, path, ttl):
+        return time.time() - os.path.getmtime(path) < (self.ttl if ttl is None else ttl)
+
+    def conditional_headers(self, headers, entry):
+        _headers = dict(headers)
+        if entry.get("etag"):
+            _headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            _headers["If-Modified-Since"] = entry["last_modified"]
+        return _headers
+
+    def get(self, url, headers, params=None, verify=CA_BUNDLE, ttl=None):
+        """(status code, JSON data), data is None unless the status is OK"""
+        _path = self.path(url, params)
+        _entry = self.load(_path)
+        if _entry is not None and self.is_fresh(_path, ttl):
+            logger.debug("Using cached response of %s %s", url, params)
+            return requests.codes.ok, _entry["data"]
+        _headers = headers
+        if _entry is not None:
+            _headers = self.conditional_headers(headers, _entry)
+        get_r = get_session().get(url, params=params, headers=_headers, verify=verify)
+        if get_r.status_code == requests.codes.not_modified and _entry is not None:
+            logger.debug("Cached response of %s %s not modified", url, params)
+            os.utime(_path, None)
+            return requests.codes.ok, _entry["data"]
+        if get_r.status_code != requests.codes.ok:
+            return get_r.status_code, None
+        return get_r.status_code, self.save(_path, get_r)
+
+    def get_pages(self, url, headers, params, items, verify=CA_BUNDLE, window=PAGE_WINDOW, ttl=None):
+        """[(status code, JSON data)...] of every page of a listing, see request_pages
+
+        The pages are cached as one entry and only reused together, while
+        younger than ttl or when every page, including the final empty one, is
+        not modified.  Otherwise all pages are requested again, so a listing
+        never mixes pages fetched at different times.
+        """
+        _path = self.path(url + "#pages", params)
+        _entry = self.load(_path)
+        if _entry is not None and self.is_fresh(_path, ttl):
+            logger.debug("Using cached pages of %s %s", url, params)
+            return [(requests.codes.ok, p["data"]) for p in _entry["pages"]]
+        if _entry is not None and all(p.get("etag") or p.get("last_modified") for p in _entry["pages"]):
+            _tasks = [(url, self.conditional_headers(headers, p), dict(params, page=i + 1), verify) for i, p in enumerate(_entry["pages"])]
+            pool = ThreadPool(processes=max(min(window, len(_tasks)), 1))
+            try:
+                _responses = pool.map(_get_page, _tasks)
+            finally:
+                pool.close()
+                pool.join()
+            if all(r.status_code == requests.codes.not_modified for r in _responses):
+                logger.debug("Cached pages of %s %s not modified", url, params)
+                os.utime(_path, None)
+                return [(requests.codes.ok, p["data"]) for p in _entry["pages"]]
+        _responses = list(request_pages(url, headers, params, items, verify=verify, window=window))
+        if _responses[-1].status_code != requests.codes.ok:
+            return [(r.status_code, None) for r in _responses]
+        _pages = [self.response_entry(r) for r in _responses]
+        self.write(_path, {"pages": _pages})
+        return [(requests.codes.ok, p["data"]) for p in _pages]
+
+
+_cache = None
+
+def set_cache(cache):
+    """Use a ResponseCache for GET requests, None to disable caching"""
+    global _cache
+    _cache = cache
+
+def get_json(url, headers, params=None, verify=CA_BUNDLE, cache=True, ttl=None):
+    """(status code, JSON data) of a GET request, through the response cache unless cache is False
+
+    Workflows that change what they read should pass cache=False.
+    """
+    if cache and _cache is not None:
+        return _cache.get(url, headers, params=params, verify=verify, ttl=ttl)
+    get_r = get_session().get(url, params=params, headers=headers, verify=verify)
+    if get_r.status_code != requests.codes.ok:
+        return get_r.status_code, None
+    return get_r.status_code, get_r.json()
+
+
+def _get_page(task):
+    _url, headers, params, verify = task
+    return get_session().get(_url, params=params, headers=headers, verify=verify)
+
+def request_pages(url, headers, params, items, verify=CA_BUNDLE, window=PAGE_WINDOW):
+    """Responses of the pages of a paginated API in order, up to the first empty or failed page
+
+    window pages are requested at once.  items returns the list of items of a
+    page's JSON data.
+    """
+    pool = ThreadPool(processes=max(window, 1))
+    _pending = deque()
+    _page = [0]
+
+    def request_next():
+        _page[0] += 1
+        _params = dict(params, page=_page[0])
+        _pending.append(pool.apply_async(_get_page, ((url, headers, _params, verify),)))
+
+    try:
+        for i in range(max(window, 1)):
+            request_next()
+        while _pending:
+            _response = _pending.popleft().get()
+            yield _response
+            if _response.status_code != requests.codes.ok or not items(_response.json()):
+                break
+            request_next()
+    finally:
+        pool.close()
+        pool.join()
+
+def iter_pages(url, headers, params, items, error, verify=CA_BUNDLE, window=PAGE_WINDOW, cache=True):
+    """Items of every page of a paginated API, in order, stopping at the first empty page
+
+    items returns the list of items of a page's JSON data, error is logged
+    before exiting if a request fails.  Uncached pages are yielded as they
+    arrive, see request_pages.  The listing goes through the response cache
+    unless cache is False, see ResponseCache.get_pages.
+    """
+    if cache and _cache is not None:
+        _pages = _cache.get_pages(url, headers, params, items, verify=verify, window=window)
+    else:
+        _pages = ((r.status_code, r.json() if r.status_code == requests.codes.ok else None)
+                  for r in request_pages(url, headers, params, items, verify=verify, window=window))
+    for _status, _data in _pages:
+        if _status != requests.codes.ok:
+            logger.fatal(error)
+            sys.exit(1)
+        _items = items(_data)
+        if not _items:
+            break
+        for _item in _items:
+            yield _item
+
+
+def get_status(url, headers, name = 'CLOSED', cache=True):
     json_data = {}
     _url = urljoin(url, "/api/statuses/%s" % name)
-    get_r = requests.get(_url, headers=headers, verify="/etc/pki/tls/certs/ca-bundle.crt")
+    _status, _data = get_json(_url, headers, cache=cache, ttl=STATUS_TTL)
 
-    if get_r.status_code == requests.codes.ok:
-        json_data = get_r.json()
+    if _status == requests.codes.ok:
+        json_data = _data
     else:
         logger.fatal("Failed to retrieve %s status data...exiting", name)
         sys.exit(1)
     return json_data.get("status")
 
 
-def get_accounts(url, headers, params):
-    json_data = {}
-    _url = urljoin(url, "/api/accounts")
-    _page = 1
-    _all_accounts = []
-    while True:
-        params["page"] = _page
-        get_r = requests.get(_url, params=params, headers=headers, verify="/etc/pki/tls/certs/ca-bundle.crt")
-
-        if get_r.status_code == requests.codes.ok:
-            json_data = get_r.json()
-        else:
-            logger.fatal("Failed to retrieve account...exiting")
-            sys.exit(1)
-        _accounts = json_data.get("accounts")
-        if _accounts:
-            _all_accounts = _all_accounts + _accounts
-            _page += 1
-        else:
-            break
-    return _all_accounts
+def iter_accounts(url, headers, params, window=PAGE_WINDOW, cache=True):
+    """Accounts as their pages arrive, see iter_pages"""
+    return iter_pages(urljoin(url, "/api/accounts"), headers, params, lambda d: d.get("accounts"),
+                      "Failed to retrieve account...exiting", window=window, cache=cache)
 
+def get_accounts(url, headers, params, window=PAGE_WINDOW, cache=True):
+    return list(iter_accounts(url, headers, params, window=window, cache=cache))
 
-def update_account(url, headers, account_id, data):
-    _url = urljoin(url, "/api/accounts/%s" % account_id)
-    data = {"account": data}
-    put_r = requests.put(_url, data=json.dumps(data), headers=headers, verify="/etc/pki/tls/certs/ca-bundle.crt")
 
-    if put_r.status_code ==requests.codes.ok:
-        return put_r.json()
-    else:
-        logging.error("Failed to update account, code: %s", put_r.status_code)
-        return None
+def is_retryable(status_code):
+    return status_code == requests.codes.too_many_requests or status_code >= 500
 
+def retry_delay(attempt, response=None):
+    """Seconds before retry attempt, Retry-After of a 429 response if given in seconds"""
+    if response is not None and response.status_code == requests.codes.too_many_requests:
+        try:
+            return min(float(response.headers.get("Retry-After")), BACKOFF_MAX)
+        except (TypeError, ValueError):
+            pass
+    return min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) + random.uniform(0, BACKOFF_BASE)
 
-def get_groups(url, headers, params):
-    json_data = {}
-    _url = urljoin(url, "/api/groups")
-    _page = 1
-    _all_groups = []
-    while True:
-        params["page"] = _page
-        get_r = requests.get(_url, params=params, headers=headers, verify=True)
-
-        if get_r.status_code == requests.codes.ok:
-            json_data = get_r.json()
-        else:
-            logger.fatal("Failed to retrieve groups...exiting")
-            sys.exit(1)
-        _groups = json_data
-        if _groups:
-            _all_groups = _all_groups + _groups
-            _page += 1
+def put_account(url, headers, account_id, data, timeout=REQUEST_TIMEOUT, retries=UPDATE_RETRIES):
+    """(updated account data, None) or (None, error), retrying timeouts, 5xx and 429 responses"""
+    _url = urljoin(url, "/api/accounts/%s" % account_id)
+    _body = json.dumps({"account": data})
+    for _attempt in range(retries + 1):
+        put_r = None
+        try:
+            put_r = get_session().put(_url, data=_body, headers=headers, verify=CA_BUNDLE, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            _error = str(e)
         else:
-            break
-    return _all_groups
+            if put_r.status_code == requests.codes.ok:
+                return put_r.json(), None
+            _error = "code: %s" % put_r.status_code
+            if not is_retryable(put_r.status_code):
+                return None, _error
+        if _attempt < retries:
+            _delay = retry_delay(_attempt, put_r)
+            logger.warning("Update of account %s failed, %s, retrying in %.1f seconds", account_id, _error, _delay)
+            time.sleep(_delay)
+    return None, _error
+
+def update_account(url, headers, account_id, data):
+    _account, _error = put_account(url, headers, account_id, data)
+    if _error:
+        logger.error("Failed to update account, %s", _error)
+    return _account
+
+
+class UpdateSummary(object):
+    """Results of update_accounts, updated maps account IDs to updated data"""
+    def __init__(self):
+        self.updated = {}
+        self.failed = []
+
+    def __str__(self):
+        return "Updated %d accounts, %d failed" % (len(self.updated), len(self.failed))
+
+def _put_task(task):
+    url, headers, account_id, data, timeout, retries = task
+    _account, _error = put_account(url, headers, account_id, data, timeout=timeout, retries=retries)
+    return account_id, _account, _error
+
+def update_accounts(url, headers, changes, jobs=UPDATE_JOBS, timeout=REQUEST_TIMEOUT, retries=UPDATE_RETRIES):
+    """Apply [(account_id, data)...], jobs requests at a time over the shared session
+
+    Returns an UpdateSummary, failed lists (account_id, error) of updates
+    that still failed after retries.
+    """
+    summary = UpdateSummary()
+    _tasks = [(url, headers, account_id, data, timeout, retries) for account_id, data in changes]
+    pool = ThreadPool(processes=max(min(jobs, POOL_SIZE), 1))
+    try:
+        for account_id, _account, _error in pool.imap_unordered(_put_task, _tasks):
+            if _error:
+                logger.error("Failed to update account %s, %s", account_id, _error)
+                summary.failed.append((account_id, _error))
+            else:
+                logger.debug("Updated account %s", account_id)
+                summary.updated[account_id] = _account
+    finally:
+        pool.close()
+        pool.join()
+    logger.info("%s", summary)
+    return summary
+
+
+def iter_groups(url, headers, params, window=PAGE_WINDOW, cache=True):
+    """Groups as their pages arrive, see iter_pages"""
+    return iter_pages(urljoin(url, "/api/groups"), headers, params, lambda d: d,
+                      "Failed to retrieve groups...exiting", verify=True, window=window, cache=cache)
+
+def get_groups(url, headers, params, window=PAGE_WINDOW, cache=True):
+    return list(iter_groups(url, headers, params, window=window, cache=cache))
@@ -0,0 +1,176 @@
+import os
+import errno
+import stat
+import time
+import logging
+import threading
+import Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging.getLogger()
+
+# Threads listing directories of one tree
+SCAN_JOBS = 8
+# Seconds between progress callbacks
+PROGRESS_INTERVAL = 30
+
+
+class ScanResult(object):
+    """Totals of a directory tree
+
+    bytes is allocated space like du, files counts everything that is not a
+    directory and the mtimes are of those files.  complete is False if the
+    scan ran out of time, errors lists (path, message) of unreadable paths.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.bytes = 0
+        self.files = 0
+        self.dirs = 0
+        self.oldest_mtime = None
+        self.newest_mtime = None
+        self.errors = []
+        self.complete = True
+
+    def add(self, st):
+        self.bytes += st.st_blocks * 512
+        if stat.S_ISDIR(st.st_mode):
+            self.dirs += 1
+            return
+        self.files += 1
+        if self.oldest_mtime is None or st.st_mtime < self.oldest_mtime:
+            self.oldest_mtime = st.st_mtime
+        if self.newest_mtime is None or st.st_mtime > self.newest_mtime:
+            self.newest_mtime = st.st_mtime
+
+    def merge(self, other):
+        self.bytes += other.bytes
+        self.files += other.files
+        self.dirs += other.dirs
+        for _mtime in (other.oldest_mtime, other.newest_mtime):
+            if _mtime is None:
+                continue
+            if self.oldest_mtime is None or _mtime < self.oldest_mtime:
+                self.oldest_mtime = _mtime
+            if self.newest_mtime is None or _mtime > self.newest_mtime:
+                self.newest_mtime = _mtime
+        self.errors += other.errors
+
+
+def _lstat(entry):
+    if scandir is not None:
+        return entry.path, entry.stat(follow_symlinks=False)
+    return entry, os.lstat(entry)
+
+def entries(path):
+    """(path, lstat) of every entry of a directory, skipping entries removed while listing"""
+    if scandir is not None:
+        _listing = scandir(path)
+    else:
+        _listing = [os.path.join(path, name) for name in os.listdir(path)]
+    for entry in _listing:
+        try:
+            yield _lstat(entry)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class DirScanner(object):
+    """Parallel du -s -x of one directory tree
+
+    Directories are listed by jobs threads from a shared queue, which keeps
+    many metadata requests in flight on network filesystems.  Symlinks are
+    not followed, directories on other devices are skipped and files with
+    several hard links are counted once.  progress is called with the partial
+    ScanResult every PROGRESS_INTERVAL seconds.
+    """
+    def __init__(self, path, jobs=SCAN_JOBS, timeout=None, progress=None):
+        self.path = path
+        self.jobs = jobs
+        self.progress = progress
+        self.deadline = time.time() + timeout if timeout else None
+        self.result = ScanResult(path)
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.inodes = set()
+        self.last_progress = time.time()
+
+    def expired(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def scan(self):
+        try:
+            _st = os.lstat(self.path)
+        except OSError as e:
+            self.result.errors.append((self.path, e.strerror))
+            return self.result
+        self.dev = _st.st_dev
+        self.result.add(_st)
+        if not stat.S_ISDIR(_st.st_mode):
+            return self.result
+        self.queue.put(self.path)
+        threads = []
+        for i in range(max(self.jobs, 1)):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        self.queue.join()
+        for t in threads:
+            self.queue.put(None)
+        for t in threads:
+            t.join()
+        return self.result
+
+    def _worker(self):
+        while True:
+            path = self.queue.get()
+            try:
+                if path is None:
+                    return
+                self._scan_dir(path)
+            finally:
+                self.queue.task_done()
+
+    def _scan_dir(self, path):
+        if self.expired():
+            self.result.complete = False
+            return
+        _result = ScanResult(path)
+        _links = []
+        try:
+            for _path, _st in entries(path):
+                if stat.S_ISDIR(_st.st_mode):
+                    # Same as du -x, other filesystems are not counted
+                    if _st.st_dev != self.dev:
+                        continue
+                    self.queue.put(_path)
+                elif _st.st_nlink > 1:
+                    _links.append(_st)
+                    continue
+                _result.add(_st)
+        except OSError as e:
+            _result.errors.append((path, e.strerror))
+        with self.lock:
+            for _st in _links:
+                if (_st.st_dev, _st.st_ino) in self.inodes:
+                    continue
+                self.inodes.add((_st.st_dev, _st.st_ino))
+                _result.add(_st)
+            self.result.merge(_result)
+            if self.progress and time.time() - self.last_progress >= PROGRESS_INTERVAL:
+                self.last_progress = time.time()
+                self.progress(self.result)
+
+
+def scan_tree(path, jobs=SCAN_JOBS, timeout=None, progress=None):
+    """ScanResult of a directory tree, see DirScanner"""
+    return DirScanner(path, jobs=jobs, timeout=timeout, progress=progress).scan()
@@ -0,0 +1,82 @@
+import logging
+import pipes
+import threading
+import paramiko
+
+logger = logging.getLogger()
+
+# Concurrent channels per connection, below the sshd MaxSessions default of 10
+MAX_CHANNELS = 8
+
+
+class RemoteCommandError(Exception):
+    def __init__(self, host, command, exit_code, stderr):
+        self.host = host
+        self.command = command
+        self.exit_code = exit_code
+        self.stderr = stderr
+        super(RemoteCommandError, self).__init__("%s on %s exited with code %s: %s" % (command, host, exit_code, stderr.strip()))
+
+
+class RemoteExecutor(object):
+    """Runs commands on one host over a single authenticated SSH transport
+
+    Every command gets its own channel on the shared transport, so many
+    commands, also from several threads at once, cost one SSH handshake.
+    The connection is opened on first use and reopened if it drops.
+    """
+    def __init__(self, host, username='root', max_channels=MAX_CHANNELS):
+        self.host = host
+        self.username = username
+        self.client = None
+        self.lock = threading.Lock()
+        self.channels = threading.BoundedSemaphore(max_channels)
+
+    def transport(self):
+        with self.lock:
+            if self.client is None or not self.client.get_transport().is_active():
+                logger.debug("Connecting to %s@%s", self.username, self.host)
+                self.client = paramiko.SSHClient()
+                self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                self.client.connect(self.host, username=self.username)
+            return self.client.get_transport()
+
+    def run(self, args):
+        """stdout of a command given as an argument list, RemoteCommandError if it fails"""
+        _command = " ".join(pipes.quote(a) for a in args)
+        logger.debug("Executing on %s: %s", self.host, _command)
+        with self.channels:
+            channel = self.transport().open_session()
+            try:
+                channel.exec_command(_command)
+                _stdout = channel.makefile('rb').read()
+                _stderr = channel.makefile_stderr('rb').read()
+                _exit_code = channel.recv_exit_status()
+            finally:
+                channel.close()
+        if _exit_code != 0:
+            raise RemoteCommandError(self.host, _command, _exit_code, _stderr)
+        return _stdout
+
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+def get_executor(host, username='root'):
+    """Shared RemoteExecutor of a host, created on first use"""
+    with _executors_lock:
+        if (host, username) not in _executors:
+            _executors[(host, username)] = RemoteExecutor(host, username=username)
+        return _executors[(host, username)]
+
+def close_executors():
+    with _executors_lock:
+        for _executor in _executors.values():
+            _executor.close()
+        _executors.clear()
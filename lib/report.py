@@ -0,0 +1,133 @@
+import csv
+import json
+import sys
+from collections import OrderedDict
+
+import prettytable
+
+FORMATS = ["table", "csv", "json", "jsonl"]
+
+
+class ReportWriter(object):
+    """Writes report tables row by row
+
+    Tables are started with a name and a list of (key, heading) columns, a
+    heading of None leaves the column out of the interactive table.  add_row
+    takes the raw values, and optionally display values for the interactive
+    table format.  Machine readable formats write each row as it is added
+    instead of building the whole table first.
+    """
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+        self.name = None
+        self.columns = None
+
+    def start_table(self, name, columns):
+        self.name = name
+        self.columns = columns
+
+    def add_row(self, values, display=None):
+        raise NotImplementedError
+
+    def add_separator(self):
+        """Blank row in the interactive table, ignored by other formats"""
+        pass
+
+    def end_table(self):
+        self.name = None
+        self.columns = None
+
+    def close(self):
+        pass
+
+    def keys(self):
+        return [c[0] for c in self.columns]
+
+
+class TableWriter(ReportWriter):
+    """prettytable output, printed when each table ends"""
+    def start_table(self, name, columns):
+        super(TableWriter, self).start_table(name, columns)
+        self.shown = [c[1] is not None for c in columns]
+        self.table = prettytable.PrettyTable([c[1] for c in columns if c[1] is not None])
+        self.table.hrules = prettytable.FRAME
+
+    def add_row(self, values, display=None):
+        if display is None:
+            display = ['' if v is None else v for v, h in zip(values, self.shown) if h]
+        self.table.add_row(display)
+
+    def add_separator(self):
+        self.table.add_row(['' for h in self.shown if h])
+
+    def end_table(self):
+        print >> self.stream, self.table
+        self.table = None
+        super(TableWriter, self).end_table()
+
+
+class CsvWriter(ReportWriter):
+    """A header line then one line per row, tables separated by a blank line"""
+    def __init__(self, stream=sys.stdout):
+        super(CsvWriter, self).__init__(stream)
+        self.writer = csv.writer(stream)
+        self.tables = 0
+
+    def start_table(self, name, columns):
+        super(CsvWriter, self).start_table(name, columns)
+        if self.tables:
+            self.stream.write("\n")
+        self.tables += 1
+        self.writer.writerow(self.keys())
+
+    def add_row(self, values, display=None):
+        self.writer.writerow(['' if v is None else v for v in values])
+
+
+class JsonLinesWriter(ReportWriter):
+    """One JSON object per row, with the table name under "table" """
+    def add_row(self, values, display=None):
+        _row = OrderedDict([("table", self.name)])
+        _row.update(zip(self.keys(), values))
+        self.stream.write(json.dumps(_row) + "\n")
+
+
+class JsonWriter(ReportWriter):
+    """A JSON object mapping table names to lists of row objects, written incrementally"""
+    def __init__(self, stream=sys.stdout):
+        super(JsonWriter, self).__init__(stream)
+        self.tables = 0
+        self.rows = 0
+
+    def start_table(self, name, columns):
+        super(JsonWriter, self).start_table(name, columns)
+        self.stream.write("{" if not self.tables else ",")
+        self.stream.write("\n  %s: [" % json.dumps(name))
+        self.tables += 1
+        self.rows = 0
+
+    def add_row(self, values, display=None):
+        if self.rows:
+            self.stream.write(",")
+        self.stream.write("\n    " + json.dumps(OrderedDict(zip(self.keys(), values))))
+        self.rows += 1
+
+    def end_table(self):
+        self.stream.write("\n  ]" if self.rows else "]")
+        super(JsonWriter, self).end_table()
+
+    def close(self):
+        self.stream.write("\n}\n" if self.tables else "{}\n")
+
+
+def report_writer(format, stream=sys.stdout):
+    """ReportWriter for one of FORMATS"""
+    if format == "table":
+        return TableWriter(stream)
+    if format == "csv":
+        return CsvWriter(stream)
+    if format == "json":
+        return JsonWriter(stream)
+    if format == "jsonl":
+        return JsonLinesWriter(stream)
+    raise ValueError("Unknown report format %s" % format)
@@ -0,0 +1,164 @@
+import os
+import stat
+import logging
+import threading
+import Queue
+
+from lib.dirscan import entries
+
+logger = logging.getLogger()
+
+# Threads removing one tree
+RM_JOBS = 8
+
+
+class RemoveResult(object):
+    """Outcome of removing a tree
+
+    bytes and inodes are what was removed, files with several hard links are
+    counted once.  errors lists (path, message) of everything that could not
+    be removed, removed is True if path itself is gone.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.bytes = 0
+        self.inodes = 0
+        self.errors = []
+        self.removed = False
+
+
+class _Dir(object):
+    __slots__ = ("path", "st", "parent", "pending", "failed")
+
+    def __init__(self, path, st, parent):
+        self.path = path
+        self.st = st
+        self.parent = parent
+        # Subdirectories not yet removed, plus one for listing this directory
+        self.pending = 1
+        self.failed = False
+
+
+class TreeRemover(object):
+    """Parallel rm -rf of one directory tree
+
+    Directories are listed by jobs threads from a shared queue, each thread
+    unlinking the files it finds.  A directory is removed once all of its
+    subdirectories are, so the tree is removed bottom-up.  Symlinks are
+    unlinked, never followed, and directories on other devices are left in
+    place and reported as errors.
+    """
+    def __init__(self, path, jobs=RM_JOBS):
+        self.path = path.rstrip("/") or path
+        self.jobs = jobs
+        self.result = RemoveResult(self.path)
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.inodes = set()
+
+    def remove(self):
+        try:
+            _st = os.lstat(self.path)
+        except OSError as e:
+            self.result.errors.append((self.path, e.strerror))
+            return self.result
+        if not stat.S_ISDIR(_st.st_mode):
+            self.result.removed = self._unlink(self.path, _st)
+            return self.result
+        self.dev = _st.st_dev
+        self.queue.put(_Dir(self.path, _st, None))
+        threads = []
+        for i in range(max(self.jobs, 1)):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        self.queue.join()
+        for t in threads:
+            self.queue.put(None)
+        for t in threads:
+            t.join()
+        return self.result
+
+    def _worker(self):
+        while True:
+            node = self.queue.get()
+            try:
+                if node is None:
+                    return
+                self._remove_dir(node)
+            finally:
+                self.queue.task_done()
+
+    def _error(self, path, e):
+        with self.lock:
+            self.result.errors.append((path, e.strerror))
+
+    def _count(self, st):
+        with self.lock:
+            # A link listed after the others were unlinked has a link count of 1
+            if (st.st_dev, st.st_ino) in self.inodes:
+                return
+            if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+                self.inodes.add((st.st_dev, st.st_ino))
+            self.result.bytes += st.st_blocks * 512
+            self.result.inodes += 1
+
+    def _unlink(self, path, st):
+        try:
+            os.unlink(path)
+        except OSError as e:
+            self._error(path, e)
+            return False
+        self._count(st)
+        return True
+
+    def _remove_dir(self, node):
+        _subdirs = []
+        try:
+            for _path, _st in entries(node.path):
+                if stat.S_ISDIR(_st.st_mode):
+                    if _st.st_dev != self.dev:
+                        with self.lock:
+                            self.result.errors.append((_path, "on another filesystem"))
+                        node.failed = True
+                        continue
+                    _subdirs.append(_Dir(_path, _st, node))
+                elif not self._unlink(_path, _st):
+                    node.failed = True
+        except OSError as e:
+            self._error(node.path, e)
+            node.failed = True
+        with self.lock:
+            node.pending += len(_subdirs)
+        for _subdir in _subdirs:
+            self.queue.put(_subdir)
+        self._done(node)
+
+    def _done(self, node):
+        """Remove node if it has no subdirectories left, then its parents"""
+        while node is not None:
+            with self.lock:
+                node.pending -= 1
+                if node.pending:
+                    return
+            if node.failed:
+                # Not empty, the error that left something behind is already recorded
+                if node.parent is not None:
+                    node.parent.failed = True
+            else:
+                try:
+                    os.rmdir(node.path)
+                    self._count(node.st)
+                    if node.parent is None:
+                        self.result.removed = True
+                except OSError as e:
+                    self._error(node.path, e)
+                    if node.parent is not None:
+                        node.parent.failed = True
+            node = node.parent
+
+
+def rmtree(path, jobs=RM_JOBS):
+    """RemoveResult of removing a file, symlink or directory tree, see TreeRemover"""
+    return TreeRemover(path, jobs=jobs).remove()
@@ -0,0 +1,86 @@
+import gzip
+import hashlib
+import os
+import time
+from datetime import datetime, timedelta
+
+from lib.slurm import sacct_command, sacct_lines, parse_sacct_time
+
+# Windows ending more recently than this may still receive accounting updates
+SETTLE_TIME = timedelta(days=1)
+
+
+def cached_lines(path):
+    f = gzip.open(path, 'rb')
+    try:
+        for line in f:
+            yield line
+    finally:
+        f.close()
+
+
+class SacctCache(object):
+    """On-disk cache of sacct output for closed time windows
+
+    Each window of each distinct query (format, account, user...) is stored as
+    a gzip file of the --parsable2 lines under directory/<query hash>/.
+    Windows that have not closed are always queried.  Cached windows older than
+    max_age days, or all windows when refresh is set, are queried again.
+    """
+    def __init__(self, directory, max_age=None, refresh=False):
+        self.directory = directory
+        self.max_age = max_age
+        self.refresh = refresh
+
+    def query_dir(self, format, sacct_args):
+        _query = " ".join(sacct_command(format, **sacct_args))
+        return os.path.join(self.directory, hashlib.sha1(_query).hexdigest()[:16])
+
+    def path(self, format, start, end, sacct_args):
+        return os.path.join(self.query_dir(format, sacct_args), "%s_%s.gz" % (start, end))
+
+    def is_closed(self, end):
+        return parse_sacct_time(end) < datetime.now() - SETTLE_TIME
+
+    def is_fresh(self, path):
+        if not os.path.isfile(path):
+            return False
+        if self.max_age is None:
+            return True
+        return time.time() - os.path.getmtime(path) < self.max_age * 86400
+
+    def sacct_lines(self, format, start, end, sacct_args):
+        """Lines of sacct output for one window, from disk when possible"""
+        _cmd = sacct_command(format, start=start, end=end, **sacct_args)
+        if not self.is_closed(end):
+            return sacct_lines(_cmd)
+        _path = self.path(format, start, end, sacct_args)
+        if not self.refresh and self.is_fresh(_path):
+            return cached_lines(_path)
+        return self._fetch(_cmd, _path)
+
+    def _fetch(self, cmd, path):
+        _dir = os.path.dirname(path)
+        if not os.path.isdir(_dir):
+            try:
+                os.makedirs(_dir)
+            except OSError:
+                # Created by another worker
+                if not os.path.isdir(_dir):
+                    raise
+            with open(os.path.join(_dir, "query.txt"), 'w') as f:
+                f.write(" ".join(cmd) + "\n")
+        _tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        _complete = False
+        f = gzip.open(_tmp_path, 'wb')
+        try:
+            for line in sacct_lines(cmd):
+                f.write(line)
+                yield line
+            _complete = True
+        finally:
+            f.close()
+            if _complete:
+                os.rename(_tmp_path, path)
+            else:
+                os.unlink(_tmp_path)
@@ -0,0 +1,275 @@
+import json
+import os
+from datetime import datetime
+
+from lib.slurm import np, slurm_duration_to_sec, slurm_time_to_epoch, sacct_record_type
+from lib.slurm import CALC_ELAPSED, CALC_START_END, CALC_START_END_SUSPENDED, TIME_BUCKETS, METRICS
+
+FORMAT_VERSION = 3
+META_FILE = "meta.json"
+# Column types by sacct field, any other field is stored as categorical codes
+DURATION_FIELDS = ('elapsed', 'suspended', 'timelimit', 'cputime', 'totalcpu', 'usercpu', 'systemcpu', 'reserved')
+TIME_FIELDS = ('start', 'end', 'submit', 'eligible')
+INTEGER_FIELDS = ('ncpus', 'nnodes', 'alloccpus', 'allocnodes', 'reqcpus', 'reqnodes')
+# Unique per job, stored as the job number and a categorical suffix such as _5 or +1
+JOBID_FIELDS = ('jobid',)
+# Stored for times that are not timestamps (Unknown, None)
+MISSING_TIME = -2 ** 63
+# Seconds that every UTC offset is a multiple of
+LOCAL_TIME_STEP = 900
+
+
+def is_columnar(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+def _to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+def _split_jobid(value):
+    """(job number, suffix) of a JobID, -1 and the whole value if it does not start with a number"""
+    _digits = len(value) - len(value.lstrip('0123456789'))
+    if not _digits:
+        return -1, value
+    return int(value[:_digits]), value[_digits:]
+
+def _to_epoch(value):
+    _epoch = slurm_time_to_epoch(value)
+    if _epoch is None:
+        return MISSING_TIME
+    return _epoch
+
+
+class SacctColumnWriter(object):
+    """Writes parsed sacct records to a directory of fixed width binary columns
+
+    Numeric fields are stored as little endian int64 (seconds for durations,
+    epoch seconds of sacct's local times).  JobIDs are stored as an int64 job
+    number and int32 codes of their array or het job suffix, all other fields
+    as int32 codes into a list of categories kept in meta.json.  Columns are appended chunk by chunk so
+    memory stays flat, and can later be memory mapped by SacctColumns.
+    """
+    def __init__(self, directory, format, chunk_size=100000):
+        if np is None:
+            raise ImportError("numpy is required to export sacct columns")
+        self.directory = directory
+        self.fields = tuple(format)
+        self.chunk_size = chunk_size
+        self.rows = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Remove meta.json first so a partial export is never mistaken for a complete one
+        if os.path.isfile(os.path.join(directory, META_FILE)):
+            os.unlink(os.path.join(directory, META_FILE))
+        self.columns = {}
+        for field in self.fields:
+            if field in DURATION_FIELDS:
+                _column = {"type": "duration", "dtype": "<i8"}
+            elif field in TIME_FIELDS:
+                _column = {"type": "time", "dtype": "<i8"}
+            elif field in INTEGER_FIELDS:
+                _column = {"type": "integer", "dtype": "<i8"}
+            elif field in JOBID_FIELDS:
+                _column = {"type": "jobid", "dtype": "<i8", "suffix_file": "%s_suffix.bin" % field, "suffix_dtype": "<i4", "suffixes": []}
+            else:
+                _column = {"type": "category", "dtype": "<i4", "categories": []}
+            _column["file"] = "%s.bin" % field
+            self.columns[field] = _column
+        self._categories = dict((f, {}) for f, c in self.columns.items() if c["type"] in ("category", "jobid"))
+        self._files = dict((f, open(os.path.join(directory, c["file"]), 'wb')) for f, c in self.columns.items())
+        self._suffix_files = dict((f, open(os.path.join(directory, c["suffix_file"]), 'wb')) for f, c in self.columns.items() if c["type"] == "jobid")
+        self._pending = []
+
+    def write(self, records):
+        """Pass records through while writing them"""
+        for record in records:
+            self._pending.append(record)
+            if len(self._pending) >= self.chunk_size:
+                self._flush()
+            yield record
+
+    def _flush(self):
+        if not self._pending:
+            return
+        for _index, field in enumerate(self.fields):
+            _column = self.columns[field]
+            _values = [r[_index] for r in self._pending]
+            if _column["type"] == "duration":
+                _values = [slurm_duration_to_sec(t=v) for v in _values]
+            elif _column["type"] == "time":
+                _values = [_to_epoch(v) for v in _values]
+            elif _column["type"] == "integer":
+                _values = [_to_int(v) for v in _values]
+            elif _column["type"] == "jobid":
+                _values, _suffixes = zip(*[_split_jobid(v) for v in _values])
+                _codes = self._category_codes(field, _column["suffixes"], _suffixes)
+                np.array(_codes, dtype=_column["suffix_dtype"]).tofile(self._suffix_files[field])
+            else:
+                _values = self._category_codes(field, _column["categories"], _values)
+            np.array(_values, dtype=_column["dtype"]).tofile(self._files[field])
+        self.rows += len(self._pending)
+        self._pending = []
+
+    def _category_codes(self, field, categories, values):
+        _codes = self._categories[field]
+        for _value in set(values):
+            if _value not in _codes:
+                _codes[_value] = len(categories)
+                categories.append(_value)
+        return [_codes[v] for v in values]
+
+    def close(self):
+        self._flush()
+        for f in self._files.values() + self._suffix_files.values():
+            f.close()
+        _meta = {
+            "version": FORMAT_VERSION,
+            "format": list(self.fields),
+            "rows": self.rows,
+            "columns": self.columns,
+        }
+        with open(os.path.join(self.directory, META_FILE), 'w') as f:
+            json.dump(_meta, f)
+
+
+class SacctColumns(object):
+    """Memory mapped columns written by SacctColumnWriter"""
+    def __init__(self, directory):
+        if np is None:
+            raise ImportError("numpy is required to read exported sacct columns")
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE), 'r') as f:
+            _meta = json.load(f)
+        if _meta.get("version") != FORMAT_VERSION:
+            raise ValueError("Unsupported sacct export version %s in %s" % (_meta.get("version"), directory))
+        self.fields = tuple(str(f) for f in _meta["format"])
+        self.rows = _meta["rows"]
+        self.columns = {}
+        self.categories = {}
+        self.integers = []
+        # field -> (suffix codes, suffixes) of JobID columns
+        self.jobids = {}
+        for field, _column in _meta["columns"].items():
+            field = str(field)
+            self.columns[field] = self._map(_column["file"], _column["dtype"])
+            if _column["type"] == "category":
+                self.categories[field] = [c.encode('utf-8') for c in _column["categories"]]
+            elif _column["type"] == "integer":
+                self.integers.append(field)
+            elif _column["type"] == "jobid":
+                self.jobids[field] = (self._map(_column["suffix_file"], _column["suffix_dtype"]), [c.encode('utf-8') for c in _column["suffixes"]])
+
+    def _map(self, filename, dtype):
+        if not self.rows:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.directory, filename), dtype=dtype, mode='r', shape=(self.rows,))
+
+    def elapsed_sec(self, calc):
+        if calc == CALC_ELAPSED:
+            return self.columns['elapsed'].astype(np.int64)
+        _start = self.columns['start']
+        _end = self.columns['end']
+        _missing = (_start == MISSING_TIME) | (_end == MISSING_TIME)
+        _elapsed = np.where(_missing, 0, _end - np.where(_missing, 0, _start))
+        if calc == CALC_START_END_SUSPENDED:
+            _elapsed = _elapsed - self.columns['suspended']
+        elif calc != CALC_START_END:
+            raise ValueError("Unknown calc %s" % calc)
+        return _elapsed
+
+    def metric(self, name, elapsed_sec):
+        """int64 column of a METRICS name"""
+        _attr, _fields, _func, _per_sec = METRICS[name]
+        if len(_fields) == 1:
+            # Text field, apply the function to each category once
+            _values = np.array([_func(c) for c in self.categories[_fields[0]]], dtype=np.int64)
+            _metric = _values[self.columns[_fields[0]]] if len(_values) else np.zeros(self.rows, dtype=np.int64)
+        elif name == 'wait':
+            _submit = self.columns['submit']
+            _start = self.columns['start']
+            _missing = (_submit == MISSING_TIME) | (_start == MISSING_TIME)
+            _metric = np.where(_missing, 0, np.maximum(_start - np.where(_missing, 0, _submit), 0))
+        else:
+            raise ValueError("Metric %s is not supported for exported columns" % name)
+        if _per_sec:
+            _metric = _metric * elapsed_sec
+        return _metric
+
+    def _record(self, index):
+        # Records only carry the text, integer and JobID fields, which is what groupings report
+        _fields = [f for f in self.fields if f in self.categories or f in self.integers or f in self.jobids]
+        _values = []
+        for f in _fields:
+            if f in self.categories:
+                _values.append(self.categories[f][self.columns[f][index]])
+            elif f in self.jobids:
+                _suffix_codes, _suffixes = self.jobids[f]
+                _number = int(self.columns[f][index])
+                _suffix = _suffixes[_suffix_codes[index]]
+                _values.append(_suffix if _number < 0 else "%d%s" % (_number, _suffix))
+            else:
+                _values.append(str(self.columns[f][index]))
+        return sacct_record_type(_fields)._make(_values)
+
+    def _field_codes(self, field):
+        """(number of codes, codes) of a text or integer column"""
+        if field in self.categories:
+            return len(self.categories[field]), self.columns[field]
+        if field in self.integers:
+            _uniques, _codes = np.unique(self.columns[field], return_inverse=True)
+            return len(_uniques), _codes
+        raise ValueError("Can not group exported columns by %s" % field)
+
+    def _time_bucket_codes(self, name):
+        # Bucket by quarter hour first, then apply the bucket to the distinct
+        # quarter hours only.  Local midnight always falls on a quarter hour.
+        _end = self.columns['end']
+        _quarters = np.where(_end == MISSING_TIME, -1, _end // LOCAL_TIME_STEP)
+        _unique_quarters, _quarter_codes = np.unique(_quarters, return_inverse=True)
+        _record_type = sacct_record_type(('end',))
+        _quarter_keys = []
+        for _quarter in _unique_quarters.tolist():
+            if _quarter < 0:
+                _end_str = "Unknown"
+            else:
+                _end_str = datetime.fromtimestamp(_quarter * LOCAL_TIME_STEP).strftime("%Y-%m-%dT%H:%M:%S")
+            _quarter_keys.append(TIME_BUCKETS[name](_record_type(_end_str)))
+        _keys, _key_codes = np.unique(np.array(_quarter_keys), return_inverse=True)
+        return _keys.tolist(), _key_codes[_quarter_codes]
+
+    def group_codes(self, name):
+        """(keys, records, codes) for a SacctAggregator group_by name"""
+        if name in TIME_BUCKETS:
+            _keys, _codes = self._time_bucket_codes(name)
+            _uniques, _first = np.unique(_codes, return_index=True)
+            return _keys, [self._record(i) for i in _first.tolist()], _codes
+        if isinstance(name, tuple):
+            _combined = np.zeros(self.rows, dtype=np.int64)
+            for _field in name:
+                _count, _codes = self._field_codes(_field)
+                _combined = _combined * _count + _codes
+            _uniques, _first, _codes = np.unique(_combined, return_index=True, return_inverse=True)
+            _records = [self._record(i) for i in _first.tolist()]
+            _keys = [tuple(getattr(r, f) for f in name) for r in _records]
+            return _keys, _records, _codes
+        if name in self.integers:
+            _uniques, _first, _codes = np.unique(self.columns[name], return_index=True, return_inverse=True)
+            return [str(v) for v in _uniques.tolist()], [self._record(i) for i in _first.tolist()], _codes
+        _count, _codes = self._field_codes(name)
+        _uniques, _first = np.unique(_codes, return_index=True)
+        _records = [None] * _count
+        for _code, _index in zip(_uniques.tolist(), _first.tolist()):
+            _records[_code] = self._record(_index)
+        return self.categories[name], _records, _codes
+
+    def aggregate(self, aggregator):
+        """Add all jobs to a NumpySacctAggregator"""
+        _elapsed_sec = self.elapsed_sec(aggregator.calc)
+        _cpu_sec = _elapsed_sec * self.columns['ncpus']
+        _metric_columns = dict((METRICS[name][0], self.metric(name, _elapsed_sec)) for name in aggregator.metrics)
+        _group_codes = dict((name, self.group_codes(name)) for name in aggregator.group_by)
+        aggregator.add_columns(_cpu_sec, _group_codes, _metric_columns, (_elapsed_sec, self.columns['ncpus'], self._record))
+        aggregator.finish()
+        return aggregator
@@ -0,0 +1,125 @@
+import sqlite3
+from datetime import timedelta
+from itertools import imap
+from multiprocessing import Pool
+
+from lib.slurm import sacct_command, sacct_lines, sacct_record_type, parse_sacct_time, SacctParser, SacctAggregator, \
+    pool_worker
+
+ROLLUP_FORMAT = "user,account,elapsed,ncpus,end"
+ROLLUP_GROUP = ("user", "account")
+ROLLUP_RECORD = sacct_record_type(ROLLUP_GROUP)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    day TEXT NOT NULL,
+    user TEXT NOT NULL,
+    account TEXT NOT NULL,
+    cpu_sec INTEGER NOT NULL,
+    num_jobs INTEGER NOT NULL,
+    PRIMARY KEY (day, user, account)
+);
+CREATE INDEX IF NOT EXISTS usage_account_day ON usage (account, day);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def days_between(start, end):
+    """YYYY-MM-DD strings for every day from start to end inclusive"""
+    _day = parse_sacct_time(start[:10])
+    _end = parse_sacct_time(end[:10])
+    days = []
+    while _day <= _end:
+        days.append(_day.strftime("%Y-%m-%d"))
+        _day += timedelta(days=1)
+    return days
+
+@pool_worker
+def rollup_day(task):
+    """Pool worker: per user and account usage of the jobs that ended on one day"""
+    _day, _sacct_args = task
+    _cmd = sacct_command(ROLLUP_FORMAT, start="%sT00:00:00" % _day, end="%sT23:59:59" % _day, **_sacct_args)
+    _aggregator = SacctAggregator(ROLLUP_FORMAT, group_by=[ROLLUP_GROUP])
+    for record in SacctParser(ROLLUP_FORMAT).parse(sacct_lines(_cmd)):
+        # Each job is attributed to the day it ended so it is stored exactly once
+        if record.end[:10] == _day:
+            _aggregator.add(record)
+    _rows = []
+    for _usage in _aggregator.groups[ROLLUP_GROUP].itervalues():
+        _user, _account = _usage.key
+        _rows.append((_day, _user, _account, _usage.cpu_sec, _usage.num_jobs))
+    return _day, _rows
+
+
+class RollupStore(object):
+    """SQLite store of CPU seconds and job counts per day, user and account
+
+    Days are those the jobs ended on.  last_day is the high-water mark of the
+    most recent day ingested, so regular ingest runs only query new days.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def last_day(self):
+        _row = self.db.execute("SELECT value FROM meta WHERE key = 'last_day'").fetchone()
+        if _row:
+            return _row[0]
+        return None
+
+    def ingest(self, days, processes=1, **sacct_args):
+        """Query sacct for each day and replace its rows, yielding (day, rows stored)"""
+        _tasks = [(day, sacct_args) for day in days]
+        pool = None
+        if processes > 1:
+            pool = Pool(processes=processes)
+            _results = pool.imap(rollup_day, _tasks)
+        else:
+            _results = imap(rollup_day, _tasks)
+        try:
+            for _day, _rows in _results:
+                # Replacing a day keeps re-ingesting it idempotent
+                with self.db:
+                    self.db.execute("DELETE FROM usage WHERE day = ?", (_day,))
+                    self.db.executemany("INSERT INTO usage (day, user, account, cpu_sec, num_jobs) VALUES (?, ?, ?, ?, ?)", _rows)
+                    _last_day = self.last_day()
+                    if _last_day is None or _day > _last_day:
+                        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_day', ?)", (_day,))
+                yield _day, len(_rows)
+            if pool:
+                pool.close()
+        except:
+            if pool:
+                pool.terminate()
+            raise
+        finally:
+            if pool:
+                pool.join()
+
+    def usage(self, start_day, end_day, account=None):
+        """(user, account, cpu_sec, num_jobs) summed over [start_day, end_day], earliest first"""
+        _sql = "SELECT user, account, SUM(cpu_sec), SUM(num_jobs) FROM usage WHERE day BETWEEN ? AND ?"
+        _params = [start_day, end_day]
+        if account:
+            _sql += " AND account = ?"
+            _params.append(account)
+        _sql += " GROUP BY user, account ORDER BY MIN(day), user, account"
+        return self.db.execute(_sql, _params)
+
+    def aggregate(self, aggregator, start_day, end_day, account=None):
+        """Add stored usage to a SacctAggregator grouping by user and/or account"""
+        for _user, _account, _cpu_sec, _num_jobs in self.usage(start_day, end_day, account=account):
+            aggregator.add_usage(ROLLUP_RECORD(_user, _account), _cpu_sec, _num_jobs)
+        aggregator.finish()
+        return aggregator
+
+    def stats(self):
+        return self.db.execute("SELECT MIN(day), MAX(day), COUNT(*), SUM(num_jobs) FROM usage").fetchone()
@@ -1,22 +1,888 @@
+from collections import namedtuple
+import heapq
+from itertools import islice, imap
+from datetime import date, datetime, timedelta
 from decimal import Decimal
-import re
+from multiprocessing import Pool
+import calendar
+import time
+from functools import wraps
+from operator import attrgetter, itemgetter
+from subprocess import Popen, PIPE, CalledProcessError
+import dateutil.parser
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SACCT_STATES = "CANCELLED,COMPLETED,FAILED,NODE_FAIL,PREEMPTED,TIMEOUT"
+
+# Ways of computing a job's elapsed seconds, see SacctAggregator
+CALC_ELAPSED = 'elapsed'
+CALC_START_END = 'start-end'
+CALC_START_END_SUSPENDED = 'start-end-suspended'
+
+# Time bucket groupings, keyed off the job end time
+TIME_BUCKETS = {
+    'day': lambda r: r.end[:10],
+    'month': lambda r: r.end[:7],
+    'year': lambda r: r.end[:4],
+}
+
+# Number of distinct duration strings kept by slurm_duration_to_sec
+DURATION_CACHE_SIZE = 100000
+# Number of distinct YYYY-MM-DD prefixes kept by slurm_time_to_epoch
+DATE_CACHE_SIZE = 10000
+SACCT_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# Memory units of TRES strings in MB
+MEM_UNITS_MB = {'K': 1.0 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+# LogHistogram resolution: 2**HIST_SUB_BITS buckets per power of two,
+# values below that are counted exactly.  Relative error is under 1/16.
+HIST_SUB_BITS = 4
+HIST_SUB_BUCKETS = 1 << HIST_SUB_BITS
+# Bucket indexes of non-negative int64 values are below this
+HIST_BUCKETS = 1024
+# Lengths of time windows used when splitting sacct queries
+WINDOW_STEPS = {
+    'day': timedelta(days=1),
+    'week': timedelta(days=7),
+}
+
+def bounded_cache(maxsize):
+    """Memoize a single argument function keeping at most ~2*maxsize entries
+
+    functools.lru_cache is not available in Python 2 and OrderedDict based LRU
+    bookkeeping costs more than the parse it saves.  Instead two dict
+    generations are kept: when the current one fills it becomes the previous
+    one, and keys still in use are promoted back on their next hit.
+    """
+    def decorator(func):
+        _generations = [{}, {}]
+        def wrapper(key):
+            _current = _generations[0]
+            try:
+                return _current[key]
+            except KeyError:
+                pass
+            if key in _generations[1]:
+                _value = _generations[1][key]
+            else:
+                _value = func(key)
+            if len(_current) >= maxsize:
+                _generations[1] = _current
+                _current = _generations[0] = {}
+            _current[key] = _value
+            return _value
+        def cache_clear():
+            _generations[:] = [{}, {}]
+        wrapper.cache_clear = cache_clear
+        wrapper.__wrapped__ = func
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+@bounded_cache(DURATION_CACHE_SIZE)
+def _duration_to_sec(t):
+    """Integer parse of DD-HH:MM:SS, HH:MM:SS or MM:SS with optional fractional seconds"""
+    _days, _sep, _clock = t.rpartition('-')
+    _parts = _clock.split(':')
+    try:
+        if len(_parts) == 3:
+            _hours, _minutes, _seconds = _parts
+        elif len(_parts) == 2:
+            _hours = 0
+            _minutes, _seconds = _parts
+        else:
+            return 0
+        _seconds, _dot, _fraction = _seconds.partition('.')
+        sec = int(_days or 0) * 86400 + int(_hours) * 3600 + int(_minutes) * 60 + int(_seconds)
+    except ValueError:
+        return 0
+    # Round half up like the previous Decimal implementation
+    if _fraction and _fraction[0] >= '5':
+        sec += 1
+    return sec
 
 def slurm_duration_to_sec(t, debug=False):
     # Format can be DD-HH:MM:SS or HH:MM:SS or MM:SS
-    m = re.search(r"(([\d]+)?-)?([\d]+)?:?([\d]{2})\:([\d\.]+)", t)
-    if debug: print "SLURM duration -> sec: %s -> %s" % (t, m.groups())
-    sec = Decimal('0.0')
-    if not m:
-        return sec
-    # Days - optional
-    if m.group(2):
-        sec += Decimal('86400.0') * Decimal(m.group(2))
-    # Hours - optional
-    if m.group(3):
-        sec += Decimal('3600.0') * Decimal(m.group(3))
-    # Minutes
-    sec += Decimal('60.0') * Decimal(m.group(4))
-    # Seconds
-    sec += Decimal(m.group(5))
-
-    return int(round(sec, 0))
+    sec = _duration_to_sec(t)
+    if debug: print "SLURM duration -> sec: %s -> %s" % (t, sec)
+    return sec
+
+@bounded_cache(DATE_CACHE_SIZE)
+def _local_day(d):
+    """(epoch seconds at local midnight, True if the UTC offset is the same all day) of a YYYY-MM-DD string"""
+    _day = date(int(d[0:4]), int(d[5:7]), int(d[8:10]))
+    _midnight = time.mktime(_day.timetuple())
+    _next_midnight = time.mktime((_day + timedelta(days=1)).timetuple())
+    return int(_midnight), _next_midnight - _midnight == 86400
+
+def slurm_time_to_epoch(t, debug=False):
+    """Epoch seconds of a sacct timestamp or None if it is not a time (Unknown, None)
+
+    sacct prints local time as YYYY-MM-DDTHH:MM:SS.  The local midnight of each
+    date is memoized and the time of day added to it, days with a DST change
+    are converted with time.mktime.  Anything else falls back to dateutil.
+    """
+    if len(t) == 19 and t[10] == 'T' and t[13] == ':' and t[16] == ':':
+        try:
+            _midnight, _uniform = _local_day(t[:10])
+            _hour, _minute, _second = int(t[11:13]), int(t[14:16]), int(t[17:19])
+            if _uniform:
+                return _midnight + _hour * 3600 + _minute * 60 + _second
+            return int(time.mktime((int(t[0:4]), int(t[5:7]), int(t[8:10]), _hour, _minute, _second, 0, 0, -1)))
+        except ValueError:
+            pass
+    try:
+        _dt = dateutil.parser.parse(t)
+    except (ValueError, OverflowError):
+        if debug: print "SLURM time %s is not a timestamp" % t
+        return None
+    if _dt.tzinfo is None:
+        return int(time.mktime(_dt.timetuple()))
+    return calendar.timegm(_dt.utctimetuple())
+
+def sec_to_slurm_duration(sec):
+    """Format seconds like sacct durations, [DD-]HH:MM:SS"""
+    _days, _sec = divmod(int(sec), 86400)
+    _clock = "%02d:%02d:%02d" % (_sec // 3600, _sec % 3600 // 60, _sec % 60)
+    if _days:
+        return "%d-%s" % (_days, _clock)
+    return _clock
+
+def cmp_start_end_time(start, end, debug=False):
+    _start = slurm_time_to_epoch(start, debug=debug)
+    _end = slurm_time_to_epoch(end, debug=debug)
+    # Jobs that never started or ended have no run time
+    if _start is None or _end is None:
+        return 0
+    _sec = _end - _start
+    return _sec
+
+def cmp_start_end_suspended_time(start, end, suspend, debug=False):
+    _end_start_sec = cmp_start_end_time(start=start, end=end, debug=debug)
+    _suspend = slurm_duration_to_sec(t=suspend, debug=debug)
+    _sec = int(_end_start_sec) - int(_suspend)
+    return _sec
+
+def parse_tres(tres):
+    """Dict of a TRES string such as billing=16,cpu=16,mem=32000M,gres/gpu=2"""
+    _tres = {}
+    for _item in tres.split(","):
+        _name, _sep, _value = _item.partition("=")
+        if _sep:
+            _tres[_name] = _value
+    return _tres
+
+def tres_gpus(tres):
+    """Number of GPUs in a TRES string, summing typed gres/gpu:<type> when there is no total"""
+    _tres = parse_tres(tres)
+    if 'gres/gpu' in _tres:
+        return int(_tres['gres/gpu'])
+    return sum(int(v) for k, v in _tres.iteritems() if k.startswith('gres/gpu:'))
+
+def tres_mem_mb(tres):
+    """Memory in MB of a TRES string, mem=<value><K|M|G|T>"""
+    _mem = parse_tres(tres).get('mem')
+    if not _mem:
+        return 0
+    _scale = MEM_UNITS_MB.get(_mem[-1].upper())
+    if _scale is None:
+        return int(float(_mem))
+    return int(round(float(_mem[:-1]) * _scale))
+
+def job_wait_sec(submit, start):
+    """Seconds from submit to start, 0 for jobs that never started"""
+    _submit = slurm_time_to_epoch(submit)
+    _start = slurm_time_to_epoch(start)
+    if _submit is None or _start is None:
+        return 0
+    return max(_start - _submit, 0)
+
+# Optional per job sums collected by SacctAggregator along with CPU seconds:
+# name -> (Usage attribute, sacct fields, function of those fields, multiplied by elapsed seconds)
+METRICS = {
+    'gpu': ('gpu_sec', ('alloctres',), tres_gpus, True),
+    'mem': ('mem_sec', ('alloctres',), tres_mem_mb, True),
+    'wait': ('wait_sec', ('submit', 'start'), job_wait_sec, False),
+}
+
+
+def parse_format(format):
+    """Convert a sacct --format string into a tuple of lower case field names"""
+    if isinstance(format, basestring):
+        format = format.split(",")
+    return tuple(f.strip().lower() for f in format if f.strip())
+
+_RECORD_TYPES = {}
+
+def _make_record(fields, values):
+    return sacct_record_type(fields)._make(values)
+
+def _reduce_record(record):
+    # Record types are created at runtime so pickle them by their fields
+    return (_make_record, (record._fields, tuple(record)))
+
+def sacct_record_type(fields):
+    """Return the namedtuple type used for records with the given fields"""
+    fields = parse_format(fields)
+    if fields not in _RECORD_TYPES:
+        _RECORD_TYPES[fields] = type('SacctRecord', (namedtuple('SacctRecord', fields),), {
+            '__slots__': (),
+            '__reduce__': _reduce_record,
+        })
+    return _RECORD_TYPES[fields]
+
+
+def sacct_command(format, account=None, user=None, start=None, end=None, cluster="brazos", states=SACCT_STATES):
+    cmd = [
+        "sacct", "--allusers", "--parsable2", "--noheader", "--allocations", "--clusters", cluster,
+    ]
+    if account:
+        cmd += ["--accounts=%s" % account]
+    if user:
+        cmd += ["--user=%s" % user]
+    cmd += ["--format", ",".join(parse_format(format))]
+    if states:
+        cmd += ["--state", states]
+    if start:
+        cmd += ["--starttime", start]
+    if end:
+        cmd += ["--endtime", end]
+    return cmd
+
+def sacct_lines(cmd):
+    """Run sacct and yield its output lines as they are written"""
+    process = Popen(cmd, stdout=PIPE, bufsize=1)
+    # readline avoids the read-ahead buffering of file iteration so lines are
+    # handed to the consumer as soon as sacct writes them
+    for line in iter(process.stdout.readline, ''):
+        yield line
+    process.stdout.close()
+    if process.wait() != 0:
+        raise CalledProcessError(process.returncode, " ".join(cmd))
+
+def sacct_file_lines(path):
+    """Yield lines from a file of saved sacct --parsable2 output"""
+    with open(path, 'r') as f:
+        for line in f:
+            yield line
+
+
+def parse_sacct_time(t):
+    """datetime of a sacct --starttime/--endtime value (YYYY-MM-DD[THH:MM[:SS]])"""
+    for _format in (SACCT_TIME_FORMAT, "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(t, _format)
+        except ValueError:
+            pass
+    raise ValueError("Unsupported sacct time %s" % t)
+
+def split_time_window(start, end, step='day'):
+    """Split [start, end] into consecutive (start, end) sacct time strings
+
+    Windows are aligned to midnight so that they can be reused between runs.
+    """
+    _start = parse_sacct_time(start)
+    _end = parse_sacct_time(end)
+    _step = WINDOW_STEPS[step]
+    _midnight = datetime(_start.year, _start.month, _start.day)
+    windows = []
+    while _start <= _end:
+        _next = _midnight + _step
+        _window_end = min(_next - timedelta(seconds=1), _end)
+        windows.append((_start.strftime(SACCT_TIME_FORMAT), _window_end.strftime(SACCT_TIME_FORMAT)))
+        _start = _midnight = _next
+    return windows
+
+def _is_sacct_time(t):
+    return len(t) == 19 and t[10] == 'T'
+
+def within_window(record, start, end):
+    """True if a job both started and ended inside [start, end]
+
+    Such jobs can only be returned by the sacct query of that window, all
+    others may be returned for several windows and need de-duplication.
+    """
+    return _is_sacct_time(record.start) and _is_sacct_time(record.end) and record.start >= start and record.end <= end
+
+class SacctError(CalledProcessError):
+    """CalledProcessError that can be pickled back from a pool worker
+
+    CalledProcessError leaves args empty, so unpickling it in the parent
+    fails inside the pool's result handler and the pool never returns.
+    """
+    def __init__(self, returncode, cmd, output=None):
+        CalledProcessError.__init__(self, returncode, cmd, output)
+        self.args = (returncode, cmd, output)
+
+def pool_worker(func):
+    """Decorate a pool worker to raise a picklable SacctError when a command fails"""
+    @wraps(func)
+    def wrapper(task):
+        try:
+            return func(task)
+        except CalledProcessError as e:
+            if isinstance(e, SacctError):
+                raise
+            raise SacctError(e.returncode, e.cmd, e.output)
+    return wrapper
+
+@pool_worker
+def _aggregate_window(task):
+    """Pool worker: query sacct for one window and aggregate the jobs inside it"""
+    _window, _format, _aggregator_args, _sacct_args, _cache = task
+    _aggregator_class, _aggregator_kwargs = _aggregator_args
+    _start, _end = _window
+    if _cache:
+        _lines = _cache.sacct_lines(_format, _start, _end, _sacct_args)
+    else:
+        _lines = sacct_lines(sacct_command(_format, start=_start, end=_end, **_sacct_args))
+    _aggregator = _aggregator_class(_format, **_aggregator_kwargs)
+    _boundary_records = []
+    for record in SacctParser(_format).parse(_lines):
+        if within_window(record, _start, _end):
+            _aggregator.add(record)
+        else:
+            _boundary_records.append(record)
+    _aggregator.finish()
+    return _aggregator, _boundary_records
+
+def windowed_aggregate(aggregator, start, end, processes=1, step='day', cache=None, **sacct_args):
+    """Run sacct for day or week windows of [start, end], optionally in a process pool
+
+    Each window aggregates the jobs that lie entirely inside it and returns
+    jobs crossing a window boundary, which are de-duplicated by JobID and
+    aggregated here so totals match a single sacct query.  Usage records are
+    the earliest job of each key, the first job of a single query when sacct
+    lists jobs by start time.  cache is an
+    optional lib.sacct_cache.SacctCache serving closed windows from disk.
+    aggregator must be created with a format including jobid; it is updated
+    and returned.
+    """
+    if 'jobid' not in aggregator.fields:
+        raise ValueError("sacct format must include jobid for windowed queries")
+    _aggregator_args = (aggregator.__class__, aggregator.options())
+    _tasks = [(w, aggregator.fields, _aggregator_args, sacct_args, cache) for w in split_time_window(start, end, step)]
+    _seen_jobids = set()
+    # Jobs crossing window boundaries are merged last like another window
+    _boundary = aggregator.__class__(aggregator.fields, **aggregator.options())
+    pool = None
+    if processes > 1:
+        pool = Pool(processes=processes)
+        # imap returns the windows in order
+        _results = pool.imap(_aggregate_window, _tasks)
+    else:
+        _results = imap(_aggregate_window, _tasks)
+    try:
+        for _partial, _boundary_records in _results:
+            aggregator.merge(_partial)
+            for record in _boundary_records:
+                if record.jobid not in _seen_jobids:
+                    _seen_jobids.add(record.jobid)
+                    _boundary.add(record)
+        aggregator.merge(_boundary)
+        if pool:
+            pool.close()
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.join()
+    aggregator.finish()
+    return aggregator
+
+
+class SacctFormatError(ValueError):
+    """sacct output does not have the fields of the requested format"""
+
+
+class SacctParser(object):
+    """Turns sacct --parsable2 lines into SacctRecord namedtuples"""
+    def __init__(self, format, debug=False):
+        self.fields = parse_format(format)
+        self.record_type = sacct_record_type(self.fields)
+        self.debug = debug
+
+    def parse(self, lines):
+        _make = self.record_type._make
+        _num_fields = len(self.fields)
+        for line in lines:
+            _line = line.strip()
+            if self.debug: print "_line: %s" % _line
+            if not _line:
+                continue
+            _data = _line.split("|")
+            if len(_data) != _num_fields:
+                raise SacctFormatError("sacct line has %d fields, expected %d (%s): %s" % (len(_data), _num_fields, ",".join(self.fields), _line))
+            yield _make(_data)
+
+
+class UsageHours(object):
+    """Hour conversions of the seconds summed by Usage and SacctAggregator"""
+    __slots__ = ()
+
+    @property
+    def cpu_hours(self):
+        return Decimal(self.cpu_sec) / Decimal('3600.0')
+
+    @property
+    def gpu_hours(self):
+        return Decimal(self.gpu_sec) / Decimal('3600.0')
+
+    @property
+    def mem_gb_hours(self):
+        return Decimal(self.mem_sec) / Decimal('3686400.0')
+
+    @property
+    def avg_wait_hours(self):
+        if not self.num_jobs:
+            return Decimal(0)
+        return Decimal(self.wait_sec) / Decimal(self.num_jobs) / Decimal('3600.0')
+
+
+def hist_bucket(value):
+    """LogHistogram bucket index of a value, negative values count as 0"""
+    if value < HIST_SUB_BUCKETS:
+        return max(value, 0)
+    _shift = value.bit_length() - HIST_SUB_BITS - 1
+    return (_shift << HIST_SUB_BITS) + (value >> _shift)
+
+def hist_buckets(values):
+    """hist_bucket of each value of an int64 array"""
+    _values = np.maximum(values, 0).astype(np.int64)
+    # frexp's exponent is the bit length, exact for values below 2**53
+    _shift = np.maximum(np.frexp(_values)[1].astype(np.int64) - HIST_SUB_BITS - 1, 0)
+    return np.where(_values < HIST_SUB_BUCKETS, _values, (_shift << HIST_SUB_BITS) + (_values >> _shift))
+
+
+class LogHistogram(object):
+    """Fixed log-linear buckets of integer values for approximate quantiles
+
+    Each bucket keeps the count and sum of its values.  Memory is bounded by
+    the number of buckets, not values, and histograms from separate workers
+    merge exactly.
+    """
+    __slots__ = ('counts', 'sums', 'total')
+
+    def __init__(self):
+        self.counts = {}
+        self.sums = {}
+        self.total = 0
+
+    def add(self, value, count=1):
+        _value = max(value, 0)
+        self.add_bucket(hist_bucket(_value), count, _value * count)
+
+    def add_bucket(self, bucket, count, value_sum):
+        self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.sums[bucket] = self.sums.get(bucket, 0) + value_sum
+        self.total += count
+
+    def merge(self, other):
+        for _bucket, _count in other.counts.iteritems():
+            self.add_bucket(_bucket, _count, other.sums[_bucket])
+        return self
+
+    def quantile(self, q):
+        """Rounded mean of the bucket holding the nearest-rank q quantile, None when empty
+
+        Exact when the bucket holds a single value, such as jobs of the same
+        runtime or core count, otherwise within the bucket's 1/16 width.
+        """
+        if not self.total:
+            return None
+        _rank = max(int(-(-q * self.total // 1)), 1)
+        _seen = 0
+        for _bucket in sorted(self.counts):
+            _count = self.counts[_bucket]
+            _seen += _count
+            if _seen >= _rank:
+                return int((2 * self.sums[_bucket] + _count) // (2 * _count))
+
+
+class JobStats(object):
+    """Largest jobs and runtime and core count distributions of one grouping key
+
+    top holds at most size (cpu_sec, jobid, elapsed_sec, ncpus, record) as a
+    min-heap so each job costs O(log size).
+    """
+    __slots__ = ('size', 'top', 'runtime', 'cores')
+
+    def __init__(self, size=0):
+        self.size = size
+        self.top = []
+        self.runtime = LogHistogram()
+        self.cores = LogHistogram()
+
+    def add(self, record, cpu_sec, elapsed_sec, ncpus):
+        self.runtime.add(elapsed_sec)
+        self.cores.add(ncpus)
+        if self.size:
+            self.add_top(record, cpu_sec, elapsed_sec, ncpus)
+
+    def add_top(self, record, cpu_sec, elapsed_sec, ncpus):
+        _job = (cpu_sec, record.jobid, elapsed_sec, ncpus, record)
+        if len(self.top) < self.size:
+            heapq.heappush(self.top, _job)
+        elif _job > self.top[0]:
+            heapq.heapreplace(self.top, _job)
+
+    def merge(self, other):
+        self.runtime.merge(other.runtime)
+        self.cores.merge(other.cores)
+        for _cpu_sec, _jobid, _elapsed_sec, _ncpus, _record in other.top:
+            self.add_top(_record, _cpu_sec, _elapsed_sec, _ncpus)
+        return self
+
+    def largest(self):
+        """(cpu_sec, jobid, elapsed_sec, ncpus, record) largest first"""
+        return sorted(self.top, reverse=True)
+
+
+def jobid_sort_key(jobid):
+    """Sort key of a JobID, by job number so 999 comes before 1000"""
+    _number = jobid.split('_')[0].split('+')[0].split('.')[0]
+    try:
+        return (int(_number), jobid)
+    except ValueError:
+        return (None, jobid)
+
+def job_order(record):
+    """Sort key of a record by start time then JobID, missing fields compare equal"""
+    return (getattr(record, 'start', ''), jobid_sort_key(getattr(record, 'jobid', '')))
+
+
+class Usage(UsageHours):
+    """CPU usage accumulated for one key of a grouping
+
+    gpu_sec (GPU seconds), mem_sec (MB seconds) and wait_sec are only summed
+    when the matching METRICS are enabled on the aggregator, and stats is a
+    JobStats for groupings in its stats_by.
+    """
+    __slots__ = ('key', 'record', 'cpu_sec', 'num_jobs', 'gpu_sec', 'mem_sec', 'wait_sec', 'stats')
+
+    def __init__(self, key, record):
+        self.key = key
+        # First record seen for this key, used to report related fields.  When
+        # aggregators are merged the earliest job by job_order is kept.
+        self.record = record
+        self.cpu_sec = 0
+        self.num_jobs = 0
+        self.gpu_sec = 0
+        self.mem_sec = 0
+        self.wait_sec = 0
+        self.stats = None
+
+
+class SacctAggregator(UsageHours):
+    """Accumulates CPU seconds and job counts in a single pass over records
+
+    group_by entries are either sacct field names (user, account, partition...),
+    tuples of field names or a time bucket from TIME_BUCKETS.  metrics are names
+    from METRICS summed along with CPU seconds.  Groupings in stats_by also
+    collect JobStats keeping the top largest jobs of each key.  Totals are
+    always collected.
+    """
+    def __init__(self, format, group_by=(), calc=CALC_ELAPSED, metrics=(), stats_by=(), top=0, debug=False):
+        self.fields = parse_format(format)
+        self.group_by = tuple(group_by)
+        self.calc = calc
+        self.metrics = tuple(metrics)
+        self.stats_by = tuple(stats_by)
+        self.top = top
+        self.debug = debug
+        self.groups = dict((name, {}) for name in self.group_by)
+        self.cpu_sec = 0
+        self.num_jobs = 0
+        self.gpu_sec = 0
+        self.mem_sec = 0
+        self.wait_sec = 0
+        self._setup()
+
+    def _setup(self):
+        debug = self.debug
+        _required = ['ncpus']
+        if self.calc == CALC_ELAPSED:
+            _required += ['elapsed']
+            self._elapsed_sec = lambda r: slurm_duration_to_sec(t=r.elapsed, debug=debug)
+        elif self.calc == CALC_START_END:
+            _required += ['start', 'end']
+            self._elapsed_sec = lambda r: cmp_start_end_time(start=r.start, end=r.end, debug=debug)
+        elif self.calc == CALC_START_END_SUSPENDED:
+            _required += ['start', 'end', 'suspended']
+            self._elapsed_sec = lambda r: cmp_start_end_suspended_time(start=r.start, end=r.end, suspend=r.suspended, debug=debug)
+        else:
+            raise ValueError("Unknown calc %s" % self.calc)
+
+        self._metric_funcs = []
+        for name in self.metrics:
+            if name not in METRICS:
+                raise ValueError("Unknown metric %s" % name)
+            _attr, _fields, _func, _per_sec = METRICS[name]
+            _required += list(_fields)
+            self._metric_funcs.append((_attr, attrgetter(*_fields), _func, _per_sec))
+
+        self._key_funcs = []
+        for name in self.group_by:
+            if name in TIME_BUCKETS:
+                _required.append('end')
+                self._key_funcs.append((self.groups[name], TIME_BUCKETS[name]))
+            elif isinstance(name, tuple):
+                # Compound grouping such as (user, account), keyed by tuples
+                _required += list(name)
+                self._key_funcs.append((self.groups[name], attrgetter(*name)))
+            else:
+                _required.append(name)
+                self._key_funcs.append((self.groups[name], attrgetter(name)))
+        self._stats_funcs = []
+        for name in self.stats_by:
+            if name not in self.group_by:
+                raise ValueError("stats_by %s is not in group_by" % (name,))
+            self._stats_funcs.append(self._key_funcs[self.group_by.index(name)])
+        if self.top and self.stats_by:
+            _required.append('jobid')
+        _missing = [f for f in _required if f not in self.fields]
+        if _missing:
+            raise ValueError("sacct format %s is missing fields: %s" % (",".join(self.fields), ",".join(_missing)))
+
+    def options(self):
+        """Keyword arguments to create an empty aggregator like this one"""
+        return dict(group_by=self.group_by, calc=self.calc, metrics=self.metrics, stats_by=self.stats_by, top=self.top)
+
+    def __getstate__(self):
+        # Drop the lambdas so partial aggregates can be returned from worker processes
+        self.finish()
+        _state = self.__dict__.copy()
+        del _state['_elapsed_sec']
+        del _state['_metric_funcs']
+        del _state['_key_funcs']
+        del _state['_stats_funcs']
+        return _state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup()
+
+    def add(self, record):
+        _elapsed_sec = self._elapsed_sec(record)
+        _ncpus = int(record.ncpus)
+        _cpu_sec = _elapsed_sec * _ncpus
+        if self.debug: print "S: %d C: %d - CS: %d" % (_elapsed_sec, _ncpus, _cpu_sec)
+        _metrics = None
+        if self._metric_funcs:
+            _metrics = []
+            for _attr, _getter, _func, _per_sec in self._metric_funcs:
+                _fields = _getter(record)
+                _value = _func(*_fields) if isinstance(_fields, tuple) else _func(_fields)
+                if _per_sec:
+                    _value *= _elapsed_sec
+                _metrics.append((_attr, _value))
+        self.add_usage(record, _cpu_sec, 1, _metrics)
+        for _group, _key_func in self._stats_funcs:
+            self._job_stats(_group, _key_func(record)).add(record, _cpu_sec, _elapsed_sec, _ncpus)
+
+    def _job_stats(self, group, key):
+        _usage = group[key]
+        if _usage.stats is None:
+            _usage.stats = JobStats(self.top)
+        return _usage.stats
+
+    def add_usage(self, record, cpu_sec, num_jobs, metrics=None):
+        """Add jobs to the totals and groupings, metrics is a list of (Usage attribute, value)"""
+        self.cpu_sec += cpu_sec
+        self.num_jobs += num_jobs
+        if metrics:
+            for _attr, _value in metrics:
+                setattr(self, _attr, getattr(self, _attr) + _value)
+        for _group, _key_func in self._key_funcs:
+            _key = _key_func(record)
+            _usage = _group.get(_key)
+            if _usage is None:
+                _usage = _group[_key] = Usage(_key, record)
+            _usage.cpu_sec += cpu_sec
+            _usage.num_jobs += num_jobs
+            if metrics:
+                for _attr, _value in metrics:
+                    setattr(_usage, _attr, getattr(_usage, _attr) + _value)
+
+    def update(self, records):
+        for record in records:
+            self.add(record)
+        self.finish()
+        return self
+
+    def finish(self):
+        """Complete any pending aggregation, called by update()"""
+        pass
+
+    def merge(self, other):
+        """Add the totals and groupings of another aggregator to this one"""
+        self.finish()
+        other.finish()
+        self.cpu_sec += other.cpu_sec
+        self.num_jobs += other.num_jobs
+        _attrs = [METRICS[name][0] for name in self.metrics]
+        for _attr in _attrs:
+            setattr(self, _attr, getattr(self, _attr) + getattr(other, _attr))
+        for name in self.group_by:
+            _group = self.groups[name]
+            for _key, _other_usage in other.groups[name].iteritems():
+                _usage = _group.get(_key)
+                if _usage is None:
+                    _usage = _group[_key] = Usage(_key, _other_usage.record)
+                elif job_order(_other_usage.record) < job_order(_usage.record):
+                    # Independent of merge order, time windows agree with a single query
+                    _usage.record = _other_usage.record
+                _usage.cpu_sec += _other_usage.cpu_sec
+                _usage.num_jobs += _other_usage.num_jobs
+                for _attr in _attrs:
+                    setattr(_usage, _attr, getattr(_usage, _attr) + getattr(_other_usage, _attr))
+                if _other_usage.stats is not None:
+                    self._job_stats(_group, _key).merge(_other_usage.stats)
+        return self
+
+    def sorted(self, name):
+        """Usage for a grouping ordered by CPU time, largest first"""
+        return sorted(self.groups[name].values(), key=attrgetter('cpu_sec'), reverse=True)
+
+
+class NumpySacctAggregator(SacctAggregator):
+    """SacctAggregator that sums with NumPy instead of per-job dict updates
+
+    Records are buffered and every chunk_size jobs, and on finish(), turned
+    into columns: elapsed seconds and ncpus as int64 arrays and group keys as
+    categorical codes from np.unique.  CPU seconds and jobs per key are then
+    summed with np.bincount into the same Usage objects SacctAggregator
+    produces.  Sums stay exact integers so reports are identical.
+    """
+    def __init__(self, format, group_by=(), calc=CALC_ELAPSED, metrics=(), stats_by=(), top=0, debug=False, chunk_size=200000):
+        if np is None:
+            raise ImportError("numpy is required for NumpySacctAggregator")
+        super(NumpySacctAggregator, self).__init__(format, group_by=group_by, calc=calc, metrics=metrics, stats_by=stats_by, top=top, debug=debug)
+        self.chunk_size = chunk_size
+        self._pending = []
+
+    def add(self, record):
+        self._pending.append(record)
+        if len(self._pending) >= self.chunk_size:
+            self.finish()
+
+    def update(self, records):
+        _records = iter(records)
+        while True:
+            self._pending.extend(islice(_records, self.chunk_size - len(self._pending)))
+            if len(self._pending) < self.chunk_size:
+                break
+            self.finish()
+        self.finish()
+        return self
+
+    def finish(self):
+        if not self._pending:
+            return
+        _records = self._pending
+        self._pending = []
+
+        def _column(name):
+            return map(itemgetter(self.fields.index(name)), _records)
+
+        def _categorize(values):
+            return np.unique(np.array(values), return_index=True, return_inverse=True)
+
+        if self.calc == CALC_ELAPSED:
+            # Parse each distinct elapsed string once
+            _values, _first, _inverse = _categorize(_column('elapsed'))
+            _elapsed = np.array([slurm_duration_to_sec(t=v) for v in _values.tolist()], dtype=np.int64)[_inverse]
+        else:
+            _elapsed = np.array([self._elapsed_sec(r) for r in _records], dtype=np.int64)
+        _values, _first, _inverse = _categorize(_column('ncpus'))
+        _ncpus = np.array([int(v) for v in _values.tolist()], dtype=np.int64)[_inverse]
+        _cpu_sec = _elapsed * _ncpus
+        _metric_columns = {}
+        for _name in self.metrics:
+            _attr, _fields, _func, _per_sec = METRICS[_name]
+            if len(_fields) == 1:
+                _values, _first, _inverse = _categorize(_column(_fields[0]))
+                _metric = np.array([_func(v) for v in _values.tolist()], dtype=np.int64)[_inverse]
+            else:
+                _metric = np.array([_func(*[r[self.fields.index(f)] for f in _fields]) for r in _records], dtype=np.int64)
+            if _per_sec:
+                _metric = _metric * _elapsed
+            _metric_columns[_attr] = _metric
+        _group_codes = {}
+        for _name, (_group, _key_func) in zip(self.group_by, self._key_funcs):
+            if isinstance(_name, tuple):
+                # Combine the codes of each field into one code per distinct tuple
+                _combined = np.zeros(len(_records), dtype=np.int64)
+                for _field in _name:
+                    _uniques, _first, _codes = _categorize(_column(_field))
+                    _combined = _combined * len(_uniques) + _codes
+                _uniques, _first, _codes = _categorize(_combined)
+                _keys = [_key_func(_records[i]) for i in _first.tolist()]
+            else:
+                if _name in self.fields:
+                    _uniques, _first, _codes = _categorize(_column(_name))
+                else:
+                    _uniques, _first, _codes = _categorize([_key_func(r) for r in _records])
+                _keys = _uniques.tolist()
+            _group_codes[_name] = (_keys, [_records[i] for i in _first.tolist()], _codes)
+        self.add_columns(_cpu_sec, _group_codes, _metric_columns, (_elapsed, _ncpus, _records.__getitem__))
+
+    def add_columns(self, cpu_sec, group_codes, metric_columns=None, jobs=None):
+        """Aggregate jobs given as columns
+
+        cpu_sec is an int64 array with one entry per job.  group_codes maps each
+        group_by name to (keys, records, codes) where codes holds an index into
+        keys, and records the record reported for each key, for every job.
+        metric_columns maps Usage attributes of enabled METRICS to int64 arrays.
+        jobs is (elapsed_sec, ncpus, function returning the record of a job
+        index), required when stats_by is set.
+        """
+        _columns = [('cpu_sec', cpu_sec)] + sorted((metric_columns or {}).items())
+        for _attr, _column in _columns:
+            setattr(self, _attr, getattr(self, _attr) + int(_column.sum()))
+        self.num_jobs += len(cpu_sec)
+        for _name, (_group, _key_func) in zip(self.group_by, self._key_funcs):
+            _keys, _records, _codes = group_codes[_name]
+            _counts = np.bincount(_codes, minlength=len(_keys))
+            # float64 weights are exact while the sum is below 2**53 seconds
+            _sums = [np.bincount(_codes, weights=c, minlength=len(_keys)).astype(np.int64).tolist() for a, c in _columns]
+            for _index, (_key, _record, _count) in enumerate(zip(_keys, _records, _counts.tolist())):
+                if not _count:
+                    continue
+                _usage = _group.get(_key)
+                if _usage is None:
+                    _usage = _group[_key] = Usage(_key, _record)
+                _usage.num_jobs += _count
+                for (_attr, _column), _sum in zip(_columns, _sums):
+                    setattr(_usage, _attr, getattr(_usage, _attr) + _sum[_index])
+            if _name in self.stats_by:
+                self._add_job_stats(_group, _keys, _codes, cpu_sec, *jobs)
+
+    def _add_job_stats(self, group, keys, codes, cpu_sec, elapsed_sec, ncpus, record_at):
+        _codes = codes.astype(np.int64)
+        for _attr, _values in (('runtime', elapsed_sec), ('cores', ncpus)):
+            # Count jobs per (key, bucket) in one pass
+            _values = np.maximum(_values, 0).astype(np.int64)
+            _combined, _inverse, _counts = np.unique(_codes * HIST_BUCKETS + hist_buckets(_values), return_inverse=True, return_counts=True)
+            # float64 weights are exact while the sum is below 2**53
+            _sums = np.bincount(_inverse, weights=_values, minlength=len(_combined)).astype(np.int64)
+            for _combined_code, _count, _sum in zip(_combined.tolist(), _counts.tolist(), _sums.tolist()):
+                _stats = self._job_stats(group, keys[_combined_code // HIST_BUCKETS])
+                getattr(_stats, _attr).add_bucket(_combined_code % HIST_BUCKETS, _count, _sum)
+        if not self.top or not len(cpu_sec):
+            return
+        # Order jobs by key then largest first, and offer the heaps every job at
+        # least as large as the top-th of its key so ties resolve as in add()
+        _order = np.lexsort((-cpu_sec, _codes))
+        _sorted_codes = _codes[_order]
+        _starts = np.searchsorted(_sorted_codes, np.arange(len(keys)))
+        _counts = np.bincount(_sorted_codes, minlength=len(keys))
+        _last = np.maximum(_starts + np.minimum(_counts, self.top) - 1, 0)
+        _threshold = cpu_sec[_order][np.minimum(_last, len(_order) - 1)]
+        for _index in np.nonzero(cpu_sec >= _threshold[_codes])[0].tolist():
+            self._job_stats(group, keys[_codes[_index]]).add_top(record_at(_index), int(cpu_sec[_index]), int(elapsed_sec[_index]), int(ncpus[_index]))
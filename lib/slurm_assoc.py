@@ -0,0 +1,175 @@
+import os
+import errno
+import time
+import logging
+from collections import OrderedDict
+from sh import sacctmgr, ErrorReturnCode
+
+logger = logging.getLogger()
+
+ASSOC_FORMAT = "User,DefaultAccount,Account,Cluster,Partition"
+# Users named by a single sacctmgr command
+SACCTMGR_BATCH_SIZE = 100
+
+
+def assoc_args(users=None):
+    """sacctmgr arguments listing every user, or only users, with all of their associations"""
+    _args = ["--parsable2", "--noheader", "show", "user", "withassoc", "format=%s" % ASSOC_FORMAT]
+    if users:
+        _args.append("name=%s" % ",".join(users))
+    return _args
+
+
+class AssocSnapshot(object):
+    """Every SLURM user association, indexed by user and by account
+
+    Built from the output of a single sacctmgr query, so checks of many
+    users cost one slurmdbd round trip.  Lines are User|DefaultAccount|
+    Account|Cluster|Partition, users without associations have an empty
+    Account.
+    """
+    def __init__(self, lines=()):
+        self.lines = []
+        self.user_accounts = {}
+        self.account_users = {}
+        self.default_accounts = {}
+        for line in lines:
+            self.add_line(line)
+
+    def add_line(self, line):
+        line = line.rstrip("\n")
+        if not line:
+            return
+        _user, _default, _account, _cluster, _partition = line.split("|")
+        self.lines.append(line)
+        self.default_accounts[_user] = _default
+        _accounts = self.user_accounts.setdefault(_user, set())
+        if _account:
+            _accounts.add(_account)
+            self.account_users.setdefault(_account, set()).add(_user)
+
+    def has_user(self, user):
+        return user in self.default_accounts
+
+    def default_account(self, user):
+        return self.default_accounts.get(user)
+
+    def accounts(self, user):
+        return sorted(self.user_accounts.get(user, ()))
+
+    def users(self, account):
+        return sorted(self.account_users.get(account, ()))
+
+    def has_assoc(self, user, account):
+        return account in self.user_accounts.get(user, ())
+
+    def __len__(self):
+        return len(self.lines)
+
+
+def is_fresh(path, ttl):
+    if not os.path.isfile(path):
+        return False
+    if ttl is None:
+        return True
+    return time.time() - os.path.getmtime(path) < ttl
+
+def load_associations(path=None, ttl=None, refresh=False, users=None):
+    """AssocSnapshot from sacctmgr, or from the file at path if younger than ttl seconds
+
+    Queried associations are saved to path when given.  refresh always queries
+    sacctmgr.  users limits the query to those users, path is not used then.
+    """
+    if users:
+        path = None
+    if path and not refresh and is_fresh(path, ttl):
+        logger.debug("Reading SLURM associations from %s", path)
+        with open(path, 'r') as f:
+            return AssocSnapshot(f)
+    logger.debug("Executing: sacctmgr %s", " ".join(assoc_args(users)))
+    snapshot = AssocSnapshot(str(sacctmgr(assoc_args(users))).splitlines())
+    logger.debug("Found %d SLURM associations", len(snapshot))
+    if path:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        _tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(_tmp_path, 'w') as f:
+            for line in snapshot.lines:
+                f.write(line + "\n")
+        os.rename(_tmp_path, path)
+    return snapshot
+
+def invalidate_snapshot(path):
+    """Remove a saved snapshot after associations were changed"""
+    if not path:
+        return
+    try:
+        os.unlink(path)
+        logger.debug("Removed SLURM association snapshot %s", path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class AssocBatch(object):
+    """Queued sacctmgr user changes, applied with one command per batch of users
+
+    Users given the same change are named together in one command, up to
+    batch_size of them, for example delete user where name=a,b,c account=x.
+    If a command fails its users are retried one at a time to find which fail.
+    """
+    def __init__(self, batch_size=SACCTMGR_BATCH_SIZE):
+        self.batch_size = batch_size
+        # (action, arguments) -> users
+        self.changes = OrderedDict()
+
+    def delete_users(self, users, account=None):
+        """Delete users, only their associations with account if given"""
+        _args = ("account=%s" % account,) if account else ()
+        self.changes.setdefault(("delete", _args), []).extend(users)
+
+    def create_users(self, users, accounts, default_account):
+        """Create users with associations to accounts"""
+        _args = ("account=%s" % ",".join(accounts), "defaultaccount=%s" % default_account)
+        self.changes.setdefault(("create", _args), []).extend(users)
+
+    def command(self, action, args, users):
+        if action == "delete":
+            return ["-i", "delete", "user", "where", "name=%s" % ",".join(users)] + list(args)
+        return ["-i", action, "user", "name=%s" % ",".join(users)] + list(args)
+
+    def _run(self, action, args, users):
+        """Users changed and [(action, user, error)...] of failures"""
+        _cmd = self.command(action, args, users)
+        logger.debug("Executing: sacctmgr %s", " ".join(_cmd))
+        try:
+            sacctmgr(_cmd)
+        except ErrorReturnCode as e:
+            _error = (e.stderr or e.stdout or str(e)).strip()
+            if len(users) == 1:
+                return [], [(action, users[0], _error)]
+            logger.warning("sacctmgr %s of %d users failed, retrying individually: %s", action, len(users), _error)
+            _done = []
+            _failed = []
+            for _user in users:
+                _done_one, _failed_one = self._run(action, args, [_user])
+                _done += _done_one
+                _failed += _failed_one
+            return _done, _failed
+        return users, []
+
+    def apply(self, noop=False):
+        """Apply and clear queued changes, returns ([(action, user)...], [(action, user, error)...])"""
+        _done = []
+        _failed = []
+        for (_action, _args), _users in self.changes.items():
+            for i in range(0, len(_users), self.batch_size):
+                _batch = _users[i:i + self.batch_size]
+                if noop:
+                    logger.info("NOOP: sacctmgr %s", " ".join(self.command(_action, _args, _batch)))
+                    continue
+                _done_batch, _failed_batch = self._run(_action, _args, _batch)
+                _done += [(_action, u) for u in _done_batch]
+                _failed += _failed_batch
+        self.changes.clear()
+        return _done, _failed
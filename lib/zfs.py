@@ -0,0 +1,154 @@
+import json
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import sh
+
+from lib.remote import RemoteCommandError
+
+logger = logging.getLogger()
+
+USERSPACE_FIELDS = "name,used,quota"
+# Properties given to a single zfs set
+SET_BATCH_SIZE = 50
+# Failures of local and remote zfs commands
+ZFS_ERRORS = (sh.ErrorReturnCode, RemoteCommandError)
+
+
+def run_zfs(args, remote=None):
+    """Output of a zfs command, run through a lib.remote.RemoteExecutor when given"""
+    if remote:
+        return remote.run(["zfs"] + args)
+    logger.debug("Executing: zfs %s", " ".join(args))
+    return str(sh.zfs(args))
+
+
+def userspace_args(fs):
+    """zfs arguments listing used bytes and quota of every user of a filesystem"""
+    return ["userspace", "-H", "-p", "-t", "posixuser", "-o", USERSPACE_FIELDS, fs]
+
+def parse_zfs_bytes(value):
+    """Bytes of a zfs -p value, 0 for unset values (- or none)"""
+    if value in ("-", "none", ""):
+        return 0
+    return int(value)
+
+
+class Userspace(object):
+    """Used bytes and quota of every user of one filesystem
+
+    Built from a single zfs userspace call and indexed by user name.  Users the
+    ZFS host can not resolve are listed by uid, so lookups fall back to it.
+    """
+    def __init__(self, fs, output=""):
+        self.fs = fs
+        self.users = {}
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            _name, _used, _quota = line.split("\t")
+            self.users[_name] = (parse_zfs_bytes(_used), parse_zfs_bytes(_quota))
+
+    def get(self, username, uid=None):
+        """(used, quota) in bytes, (0, 0) for users without either"""
+        if username in self.users:
+            return self.users[username]
+        if uid is not None and str(uid) in self.users:
+            return self.users[str(uid)]
+        return (0, 0)
+
+    def __len__(self):
+        return len(self.users)
+
+
+def get_userspace(fs, remote=None):
+    return Userspace(fs, run_zfs(userspace_args(fs), remote=remote))
+
+
+class SetJournal(object):
+    """Append-only JSON lines audit log of zfs set results
+
+    Every run appends to the same file, nothing is skipped because of it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.f = open(path, 'a')
+
+    def record(self, fs, props, error=None):
+        _time = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with self.lock:
+            for prop in props:
+                _entry = {"time": _time, "fs": fs, "property": prop, "status": "failed" if error else "ok"}
+                if error:
+                    _entry["error"] = error
+                self.f.write(json.dumps(_entry, sort_keys=True) + "\n")
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def zfs_set(fs, props, remote=None):
+    run_zfs(["set"] + list(props) + [fs], remote=remote)
+
+def _error_message(e):
+    return (getattr(e, "stderr", "") or str(e)).strip()
+
+def _apply_batch(task):
+    _fs, _props, _journal, _remote = task
+    _failed = []
+    try:
+        zfs_set(_fs, _props, remote=_remote)
+        _ok = _props
+    except ZFS_ERRORS as e:
+        if len(_props) == 1:
+            _ok = []
+            _failed.append((_fs, _props[0], _error_message(e)))
+        else:
+            # Retry one property at a time to find which ones fail
+            logger.warning("zfs set of %d properties on %s failed, retrying individually: %s", len(_props), _fs, _error_message(e))
+            _ok = []
+            for _prop in _props:
+                _ok_one, _failed_one = _apply_batch((_fs, [_prop], _journal, _remote))
+                _ok += _ok_one
+                _failed += _failed_one
+            return _ok, _failed
+    if _journal:
+        if _ok:
+            _journal.record(_fs, _ok)
+        for _fs_failed, _prop, _error in _failed:
+            _journal.record(_fs_failed, [_prop], error=_error)
+    return _ok, _failed
+
+def apply_properties(changes, jobs=1, batch_size=SET_BATCH_SIZE, journal=None, noop=False, remote=None):
+    """Set (fs, "property=value") changes, batch_size per zfs set and jobs at a time
+
+    Returns (properties set, [(fs, property, error)...]).  Results are
+    recorded in journal if given.  remote is an optional RemoteExecutor of
+    the ZFS host.
+    """
+    _by_fs = {}
+    for _fs, _prop in changes:
+        _by_fs.setdefault(_fs, []).append(_prop)
+    _tasks = []
+    for _fs in sorted(_by_fs):
+        _props = _by_fs[_fs]
+        for i in range(0, len(_props), batch_size):
+            _tasks.append((_fs, _props[i:i + batch_size], journal, remote))
+    if noop:
+        for _fs, _props, _journal, _remote in _tasks:
+            logger.info("NOOP: zfs %s", " ".join(["set"] + _props + [_fs]))
+        return 0, []
+    _set = 0
+    _failed = []
+    pool = ThreadPool(processes=max(jobs, 1))
+    try:
+        for _ok, _failed_batch in pool.imap_unordered(_apply_batch, _tasks):
+            _set += len(_ok)
+            _failed += _failed_batch
+    finally:
+        pool.close()
+        pool.join()
+    return _set, _failed
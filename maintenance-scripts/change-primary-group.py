@@ -5,7 +5,7 @@ import os, sys
 import logging
 import json
 import ldap
-from sh import sacctmgr, find, ErrorReturnCode
+from sh import find, ErrorReturnCode
 
 BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 sys.path.append(BASE_DIR)
@@ -13,6 +13,7 @@ from lib import actmgr_api
 from lib.config import load_config
 from lib.logs import setup_logging
 from lib.local_ldap import LocalLdap, LdapUser, LdapGroup
+from lib.slurm_assoc import load_associations, invalidate_snapshot, AssocBatch
 
 logger = logging.getLogger()
 
@@ -44,6 +45,10 @@ def main():
     # Setup logging
     setup_logging(debug=args.debug, noop=False)
 
+    _api_cache_config = config[args.config_env].get("actmgr_cache", {})
+    if _api_cache_config.get("dir"):
+        actmgr_api.set_cache(actmgr_api.ResponseCache(_api_cache_config["dir"], ttl=_api_cache_config.get("ttl", 300)))
+
     logger.debug4("OPTIONS: %s" % options)
     logger.debug4("CONFIG: %s" % config_env)
 
@@ -137,7 +142,8 @@ def main():
     get_account_params = {
         "username": args.username,
     }
-    account_data = actmgr_api.get_accounts(_url, _json_headers, get_account_params)
+    # The account is changed below, always read it from the API
+    account_data = actmgr_api.get_accounts(_url, _json_headers, get_account_params, cache=False)
     account = account_data[0]
     logger.debug("Account API data: %s", json.dumps(account))
 
@@ -190,38 +196,28 @@ def main():
         logger.error("SLURM accounts not correctly determined")
         sys.exit(1)
 
-    sacctmgr_check_args = [
-        "--parsable2", "--noheader", "show", "user",
-        "name=%s" % args.username, "account=%s" % _slurm_account,
-        "format=User,DefaultAccount,Account", "WithAssoc",
-    ]
-    logger.debug("Executing: sacctmgr %s", " ".join(sacctmgr_check_args))
+    _assoc_config = config[args.config_env].get("slurm_assoc", {})
     try:
-        output = sacctmgr(sacctmgr_check_args)
+        associations = load_associations(users=[args.username])
     except ErrorReturnCode:
         logger.error("FAILED to check if SLURM account already exists.")
         sys.exit(1)
-    expected_output = "%s|%s|%s" % (args.username, _slurm_account, _slurm_account)
-    existing_slurm_accounts = output.split(os.linesep)
-    if expected_output not in existing_slurm_accounts:
-        sacctmgr_delete_args = ["-i", "delete", "user","where", "name=%s" % args.username, "account=%s" % ldap_group_old.slurmAccountName]
-        logger.debug("Executing: sacctmgr %s", " ".join(sacctmgr_delete_args))
-        try:
-            output = sacctmgr(sacctmgr_delete_args)
-        except ErrorReturnCode:
-            logger.error("FAILED to delete user from SLURM.")
+    _slurm_record_exists = (associations.default_account(args.username) == _slurm_account and
+                            associations.has_assoc(args.username, _slurm_account))
+    if not _slurm_record_exists:
+        batch = AssocBatch()
+        batch.delete_users([args.username], account=ldap_group_old.slurmAccountName)
+        _done, _failed = batch.apply()
+        if _failed:
+            logger.error("FAILED to delete user from SLURM: %s", _failed[0][2])
             sys.exit(1)
 
-        sacctmgr_create_args = [
-            "-i", "create", "user", args.username,
-            "account=%s" % ",".join(_slurm_accounts),
-            "defaultaccount=%s" % _slurm_account,
-        ]
-        logger.debug("Executing: sacctmgr %s", " ".join(sacctmgr_create_args))
-        try:
-            output = sacctmgr(sacctmgr_create_args)
-        except ErrorReturnCode:
-            logger.error("FAILED to retrieve all user names from SLURM.")
+        batch.create_users([args.username], _slurm_accounts, _slurm_account)
+        _done, _failed = batch.apply()
+        # The delete already changed the associations
+        invalidate_snapshot(_assoc_config.get("snapshot"))
+        if _failed:
+            logger.error("FAILED to create user in SLURM: %s", _failed[0][2])
             sys.exit(1)
     else:
         logger.warn("Skipping SLURM account modifications - record already exists")
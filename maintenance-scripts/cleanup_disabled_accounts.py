@@ -2,14 +2,16 @@
 
 import argparse
 import os, sys, stat
+import time
 import logging
+import threading
 from pwd import getpwuid, getpwnam
-import paramiko
 import requests
 import json
 from urlparse import urljoin
+from multiprocessing.pool import ThreadPool
 import prettytable
-from sh import du, rm, unlink, sacctmgr, ErrorReturnCode
+from sh import ErrorReturnCode
 
 BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 sys.path.append(BASE_DIR)
@@ -17,6 +19,11 @@ from lib import actmgr_api
 from lib.config import load_config
 from lib.logs import setup_logging
 from lib.byte_converter import bytes2human
+from lib.remote import get_executor, close_executors
+from lib.zfs import get_userspace
+from lib.dirscan import scan_tree, ScanResult, SCAN_JOBS
+from lib.rmtree import rmtree, RM_JOBS
+from lib.slurm_assoc import load_associations, invalidate_snapshot, AssocBatch, SACCTMGR_BATCH_SIZE
 
 logger = logging.getLogger()
 
@@ -28,54 +35,150 @@ if os.path.isfile('/tmp/beegfs_userspace.json'):
     for _user in _beegfs_used:
         BEEGFS_USED[_user["name"]] = int(_user["space"])
 FDATA_USERS = []
-
-
-def get_space_used(path, host=None):
-    if not os.path.isdir(path):
-        return 0
-    _user = os.path.basename(path)
-    # Get /home usage from ZFS
-    if os.path.dirname(path) == "/home":
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, username='root')
-        stdin, stdout, stderr = ssh.exec_command("zfs get -H -p -o value userused@%s tank/home" % _user)
-        out = stdout.read().splitlines()
-        logger.debug1("HOME zfs output for %s: %s", _user, out)
-        if type(out) is list:
-            _value = out[0]
-        else:
-            _value = out
-        if _value == '-':
-            _value = 0
-        return int(_value)
-    # Get /fdata usage from quota reports in /tmp
-    if "/fdata" in path:
-        if _user in FDATA_USERS:
+# Results of cleanup
+REMOVED = "REMOVED"
+NOT_REMOVED = "NOT REMOVED"
+DELETED = "DELETED"
+FAILED = "FAILED"
+NOOP = "NOOP"
+# zfs userspace of the home filesystem by (host, filesystem), read once over SSH
+HOME_USERSPACE = {}
+
+
+class SpaceIndex(object):
+    """Space used by every path of a report, gathered before the report is built
+
+    Home directories come from the zfs userspace of the home filesystem and
+    /fdata directories from the BeeGFS quota report, unless scan_all is set.
+    The remaining paths are scanned with lib.dirscan, jobs trees at a time,
+    giving up on a tree after timeout seconds.  Paths that could not be
+    measured are None.
+    """
+    def __init__(self, host=None, fs="tank/home", jobs=4, scan_jobs=SCAN_JOBS, timeout=None, scan_all=False):
+        self.host = host
+        self.fs = fs
+        self.jobs = jobs
+        self.scan_jobs = scan_jobs
+        self.timeout = timeout
+        self.scan_all = scan_all
+        self.used = {}
+        self.scans = {}
+
+    def bulk_used(self, path):
+        """Bytes used from bulk sources, None if path needs scanning"""
+        if not os.path.isdir(path):
             return 0
-        if _user in BEEGFS_USED:
-            FDATA_USERS.append(_user)
-            return int(BEEGFS_USED[_user])
-    # If the above methods failed for some reason, use du
-    logger.debug1("Executing: du -s -x %s", path)
-    _du_out = du("-s", "-x", path)
-    _du_split = _du_out.split()
-
-    _du_used = _du_split[0]
-    _du_path = _du_split[1]
-    if _du_path != path:
-        logger.error("du %s invalid", path)
-        return False
-    return int(_du_used) * 1024
+        _user = os.path.basename(path)
+        # Get /home usage from ZFS
+        if os.path.dirname(path) == "/home":
+            if (self.host, self.fs) not in HOME_USERSPACE:
+                HOME_USERSPACE[(self.host, self.fs)] = get_userspace(self.fs, remote=get_executor(self.host))
+            _used, _quota = HOME_USERSPACE[(self.host, self.fs)].get(_user)
+            logger.debug1("HOME zfs used for %s: %s", _user, _used)
+            return _used
+        if self.scan_all:
+            return None
+        # Get /fdata usage from quota reports in /tmp
+        if "/fdata" in path:
+            if _user in FDATA_USERS:
+                return 0
+            if _user in BEEGFS_USED:
+                FDATA_USERS.append(_user)
+                return int(BEEGFS_USED[_user])
+        return None
+
+    def _progress(self, result):
+        logger.info("Scanning %s: %d files, %s so far", result.path, result.files, bytes2human(result.bytes))
+
+    def _scan(self, path):
+        logger.debug1("Scanning %s", path)
+        return path, scan_tree(path, jobs=self.scan_jobs, timeout=self.timeout, progress=self._progress)
+
+    def build(self, paths):
+        _scan_paths = []
+        for path in paths:
+            if path in self.used:
+                continue
+            _used = self.bulk_used(path)
+            if _used is None:
+                _scan_paths.append(path)
+            self.used[path] = _used
+        if not _scan_paths:
+            return
+        # If the above methods failed for some reason, scan the directories
+        logger.info("Scanning %d directories, %d at a time", len(_scan_paths), self.jobs)
+        pool = ThreadPool(processes=max(self.jobs, 1))
+        try:
+            for path, _result in pool.imap_unordered(self._scan, _scan_paths):
+                for _path, _error in _result.errors:
+                    logger.warn("Unable to read %s: %s", _path, _error)
+                if not _result.complete:
+                    logger.error("Scan of %s timed out after %s seconds", path, self.timeout)
+                    continue
+                self.used[path] = _result.bytes
+                self.scans[path] = _result
+        finally:
+            pool.close()
+            pool.join()
+
+    def get(self, path):
+        return self.used.get(path)
+
+    def scan(self, path):
+        """ScanResult of a scanned path, None for paths from bulk sources"""
+        return self.scans.get(path)
+
+
+def add_used(a, b):
+    """Sum of two space used values, None if either is unknown"""
+    if a is None or b is None:
+        return None
+    return a + b
+
+def used2human(used):
+    if used is None:
+        return "unknown"
+    return bytes2human(used)
+
+def format_mtime(mtime):
+    if mtime is None:
+        return ""
+    return time.strftime("%Y-%m-%d", time.localtime(mtime))
+
+class FilesystemLimits(object):
+    """Caps the number of concurrent removals on each filesystem
+
+    Paths are grouped by the device of their parent directory, so all
+    account directories under /home share a limit, as do all directories
+    on the BeeGFS mounts.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def get(self, path):
+        _parent = os.path.dirname(path.rstrip("/"))
+        try:
+            _fs = os.stat(_parent).st_dev
+        except OSError:
+            _fs = _parent
+        with self.lock:
+            if _fs not in self.semaphores:
+                self.semaphores[_fs] = threading.BoundedSemaphore(self.limit)
+            return self.semaphores[_fs]
+
 
 class AccountHome(object):
-    def __init__(self, username, config, options={}):
+    def __init__(self, username, config, options={}, fs_limits=None):
         self.username = username
         self.home = os.path.join(config["base_dir"], self.username)
         self.scratch = os.path.join(config["scratch_base"], self.username)
         self.verbose = options.get('debug')
         self.noop = options.get('noop')
         self.force = options.get('force')
+        self.fs_limits = fs_limits
+        self.rm_jobs = options.get('rm_jobs') or RM_JOBS
         self.check_extra_directories(extra_dirs=config.get("extra_scratch_directories", []))
 
     def home_exists(self):
@@ -103,77 +206,59 @@ class AccountHome(object):
             self.extra_directories_exist = False
 
     def cleanup(self):
+        """Remove HOME, SCRATCH and extra directories
+
+        Returns [(path, result, RemoveResult)...], the RemoveResult is None
+        in noop mode.
+        """
         if not self.home_exists() and not self.scratch_exists() and not self.extra_directories_exist:
             logger.debug("HOME, SCRATCH and extra directories do not exist: %s, skipping.", self.username)
-            return True
+            return []
 
+        _paths = []
         if self.home_exists():
-            _rm_home = True
-            self.check_path_owner(self.home)
-            logger.info("Removing %s", self.home)
-            self.rmdir(self.home)
+            _paths.append(self.home)
         else:
-            _rm_home = False
             logger.debug("HOME not found for %s", self.username)
-
         if self.scratch_exists():
-            _rm_scratch = True
-            self.check_path_owner(self.scratch)
-            logger.info("Removing %s", self.scratch)
-            self.rmdir(self.scratch)
+            _paths.append(self.scratch)
         else:
-            _rm_scratch = False
             logger.debug("SCRATCH not found for %s", self.username)
-
-        for _dir in self.extra_directories:
-            self.check_path_owner(_dir)
-            logger.info("Removing %s", _dir)
-            self.rmdir(_dir)
-
-        if self.noop:
-            return True
-
-        if _rm_home:
-            if not self.home_exists():
-                logger.info("SUCCESS: Removed %s", self.home)
+        _paths += self.extra_directories
+
+        _removals = {}
+        for _path in _paths:
+            self.check_path_owner(_path)
+            logger.info("Removing %s", _path)
+            if self.fs_limits:
+                with self.fs_limits.get(_path):
+                    _removals[_path] = self.rmdir(_path)
             else:
-                logger.error("Not removed %s", self.home)
-        if _rm_scratch:
-            if not self.scratch_exists():
-                logger.info("SUCCESS: Removed %s", self.scratch)
+                _removals[_path] = self.rmdir(_path)
+
+        _results = []
+        for _path in _paths:
+            if self.noop:
+                _results.append((_path, NOOP, None))
+            elif os.path.isdir(_path):
+                logger.error("Not removed %s", _path)
+                _results.append((_path, NOT_REMOVED, _removals[_path]))
             else:
-                logger.error("Not removed %s", self.scratch)
-
-        for _dir in self.extra_directories:
-            if os.path.isdir(_dir):
-                logger.error("Not removed %s", _dir)
-            else:
-                logger.info("SUCCESS: Removed %s", _dir)
-
-        return True
+                logger.info("SUCCESS: Removed %s", _path)
+                _results.append((_path, REMOVED, _removals[_path]))
+        return _results
 
 
     def rmdir(self, path):
-        if os.path.islink(path):
-            _link = True
-        else:
-            _link = False
-        if _link:
-            logger.debug1("Executing: unlink %s", path)
-        else:
-            logger.debug1("Executing: rm -rf %s", path)
-        if self.noop: return True
-        try:
-            if _link:
-                output = unlink(path)
-            else:
-                output = rm("-rf", path)
-        except ErrorReturnCode:
-            logger.error("FAILED deleting %s: Exit code %s", path, output.exit_code)
-            logger.error(output)
-            return False
-        logger.info("%s deleted.", path)
-        return True
+        """RemoveResult of removing path, None in noop mode"""
+        logger.debug1("Removing tree %s", path)
+        if self.noop: return None
+        _result = rmtree(path, jobs=self.rm_jobs)
+        for _path, _error in _result.errors:
+            logger.error("FAILED deleting %s: %s", _path, _error)
+        if _result.removed:
+            logger.info("%s deleted, freed %s in %d inodes.", path, bytes2human(_result.bytes), _result.inodes)
+        return _result
 
     def check_path_owner(self, path):
         if not os.path.isdir(path):
@@ -193,22 +278,21 @@ class AccountHome(object):
 
 
 class SlurmAccount(object):
-    all_usernames = []
+    associations = None
+    snapshot_path = None
+    snapshot_ttl = None
 
     @classmethod
     def get_all(cls):
-        if cls.all_usernames:
-            return cls.all_usernames
+        if cls.associations is not None:
+            return cls.associations
 
-        sacctmgr_args = ["--parsable2", "--noheader", "show", "user", "format=user"]
-        logger.debug1("Executing: sacctmgr %s", " ".join(sacctmgr_args))
         try:
-            output = sacctmgr(sacctmgr_args)
+            cls.associations = load_associations(path=cls.snapshot_path, ttl=cls.snapshot_ttl)
         except ErrorReturnCode:
             logger.error("FAILED to retrieve all user names from SLURM.")
             sys.exit(1)
-        cls.all_usernames = output.splitlines()
-        return cls.all_usernames
+        return cls.associations
 
     def __init__(self, username, options={}):
         self.username = username
@@ -216,30 +300,81 @@ class SlurmAccount(object):
         self.noop = options.get('noop')
         self.force = options.get('force')
 
-    def delete(self):
-        if not self.exists():
-            logger.debug("SLURM account does not exist: %s, skipping.", self.username)
-            return True
-
-        logger.info("Deleting SLURM account: %s", self.username)
-        sacctmgr_args = ["-i", "delete", "user","where", "name=%s" % self.username]
-        logger.debug1("Executing: sacctmgr %s", " ".join(sacctmgr_args))
-        if self.noop: return True
-        try:
-            output = sacctmgr(sacctmgr_args)
-        except ErrorReturnCode:
-            logger.error("FAILED deleting SLURM account %s: Exit code %s", self.username, exit_code)
-            logger.error(output)
-            return False
-        logger.info("%s SLURM account deleted.", self.username)
-        return True
+    @classmethod
+    def delete_all(cls, slurm_accounts, noop=False, batch_size=SACCTMGR_BATCH_SIZE):
+        """Delete existing SLURM users with batched sacctmgr commands, returns {username: result}"""
+        _results = {}
+        batch = AssocBatch(batch_size=batch_size)
+        _usernames = []
+        for _slurm_account in slurm_accounts:
+            if not _slurm_account.exists():
+                logger.debug("SLURM account does not exist: %s, skipping.", _slurm_account.username)
+                continue
+            logger.info("Deleting SLURM account: %s", _slurm_account.username)
+            _usernames.append(_slurm_account.username)
+        if not _usernames:
+            return _results
+        batch.delete_users(_usernames)
+        _done, _failed = batch.apply(noop=noop)
+        if noop:
+            return dict((u, NOOP) for u in _usernames)
+        if _done:
+            invalidate_snapshot(cls.snapshot_path)
+        for _action, _username in _done:
+            logger.info("%s SLURM account deleted.", _username)
+            _results[_username] = DELETED
+        for _action, _username, _error in _failed:
+            logger.error("FAILED deleting SLURM account %s: %s", _username, _error)
+            _results[_username] = FAILED
+        return _results
 
     def exists(self):
-        if self.username in self.__class__.get_all():
-            return True
-        else:
-            return False
-
+        return self.__class__.get_all().has_user(self.username)
+
+
+def cleanup_account(account_home):
+    """Cleanup of one account's directories, (username, [(path, result, RemoveResult)...])"""
+    try:
+        return account_home.username, account_home.cleanup()
+    except Exception as e:
+        logger.exception("FAILED cleanup of %s: %s", account_home.username, e)
+        return account_home.username, [("", FAILED, None)]
+
+def print_cleanup_results(results):
+    table = prettytable.PrettyTable(["Username", "Directories", "Result", "Freed", "Inodes", "Errors", "SLURM"])
+    table.hrules = prettytable.FRAME
+    _counts = {}
+    _slurm_counts = {}
+    _bytes_total = 0
+    _inodes_total = 0
+    _errors_total = 0
+    for _username, _paths, _slurm in sorted(results):
+        _freed = []
+        _inodes = []
+        _errors = []
+        for _path, _result, _removal in _paths:
+            _counts[_result] = _counts.get(_result, 0) + 1
+            if _removal is None:
+                _freed.append("")
+                _inodes.append("")
+                _errors.append("")
+                continue
+            _bytes_total += _removal.bytes
+            _inodes_total += _removal.inodes
+            _errors_total += len(_removal.errors)
+            _freed.append(bytes2human(_removal.bytes))
+            _inodes.append(str(_removal.inodes))
+            _errors.append(str(len(_removal.errors)))
+        if _slurm:
+            _slurm_counts[_slurm] = _slurm_counts.get(_slurm, 0) + 1
+        table.add_row([_username, "\n".join(p[0] for p in _paths), "\n".join(p[1] for p in _paths),
+                       "\n".join(_freed), "\n".join(_inodes), "\n".join(_errors), _slurm])
+    table.add_row(["", "", "", "", "", "", ""])
+    table.add_row(["Total", len(results),
+                   "\n".join("%s: %d" % (r, c) for r, c in sorted(_counts.items())),
+                   bytes2human(_bytes_total), _inodes_total, _errors_total,
+                   "\n".join("%s: %d" % (r, c) for r, c in sorted(_slurm_counts.items()))])
+    print table
 
 def main():
     parser = argparse.ArgumentParser()
@@ -249,6 +384,14 @@ def main():
     parser.add_argument('--noop', help="only print actions, make no changes", dest="noop", action="store_true", default=False)
     parser.add_argument('--report', help="generate report of what will be done", dest="report", action="store_true", default=False)
     parser.add_argument('--report-space', help="report on space that can be removed", dest="report_space", action="store_true", default=False)
+    parser.add_argument('--jobs', help="number of accounts cleaned up at once", dest="jobs", type=int, default=1)
+    parser.add_argument('--fs-jobs', help="number of directories removed at once from each filesystem", dest="fs_jobs", type=int, default=2)
+    parser.add_argument('--sacctmgr-batch-size', help="number of SLURM users deleted by each sacctmgr command", dest="sacctmgr_batch_size", type=int, default=SACCTMGR_BATCH_SIZE)
+    parser.add_argument('--rm-jobs', help="number of threads removing each directory", dest="rm_jobs", type=int, default=RM_JOBS)
+    parser.add_argument('--report-files', help="scan SCRATCH and extra directories for --report-space, adding file counts and newest file", dest="report_files", action="store_true", default=False)
+    parser.add_argument('--space-jobs', help="number of directories scanned at once for --report-space", dest="space_jobs", type=int, default=4)
+    parser.add_argument('--scan-jobs', help="number of threads scanning each directory for --report-space", dest="scan_jobs", type=int, default=SCAN_JOBS)
+    parser.add_argument('--scan-timeout', help="seconds before giving up on scanning a directory for --report-space", dest="scan_timeout", type=int, default=None)
     parser.add_argument('--account', help="account to create", dest="account", default=None)
     parser.add_argument('--exclude-accounts', nargs="+", help="accounts to exclude", dest="exclude_accounts", default=[])
     args = parser.parse_args()
@@ -259,6 +402,9 @@ def main():
     _auth_token = config[args.config_env].get("api_auth_token")
     _account_home_config = config[args.config_env].get("account_home")
     _cleanup_exclude = _account_home_config.get("cleanup_exclude", []) + args.exclude_accounts
+    _assoc_config = config[args.config_env].get("slurm_assoc", {})
+    SlurmAccount.snapshot_path = _assoc_config.get("snapshot")
+    SlurmAccount.snapshot_ttl = _assoc_config.get("ttl")
     _host = config[args.config_env].get("host")
     _port = config[args.config_env].get("port")
     _https = config[args.config_env].get("https")
@@ -273,6 +419,10 @@ def main():
     # Setup logging
     setup_logging(debug=args.debug, noop=args.noop)
 
+    _api_cache_config = config[args.config_env].get("actmgr_cache", {})
+    if _api_cache_config.get("dir"):
+        actmgr_api.set_cache(actmgr_api.ResponseCache(_api_cache_config["dir"], ttl=_api_cache_config.get("ttl", 300)))
+
     logger.debug4("OPTIONS: %s" % options)
     logger.debug4("CONFIG: %s" % config)
 
@@ -281,14 +431,16 @@ def main():
     logger.debug1("STATUS: %s", status)
     status_id = status.get("id")
 
-    # Get accounts and perform account cleanup steps
+    # Get accounts and perform account cleanup steps, only reports use cached accounts
     if args.account:
-        accounts = actmgr_api.get_accounts(url=_url, headers=_json_headers, params={"username": args.account, "status_id": status_id})
+        accounts = actmgr_api.get_accounts(url=_url, headers=_json_headers, params={"username": args.account, "status_id": status_id}, cache=args.report)
     else:
-        accounts = actmgr_api.get_accounts(url=_url, headers=_json_headers, params={"status_id": status_id})
+        accounts = actmgr_api.get_accounts(url=_url, headers=_json_headers, params={"status_id": status_id}, cache=args.report)
     logger.debug4("Number of accounts returned: %s", len(accounts))
 
     _report = []
+    _cleanups = []
+    fs_limits = FilesystemLimits(args.fs_jobs)
     for account in accounts:
         logger.debug4("Account data: %s", json.dumps(account))
         _username = account["username"]
@@ -304,7 +456,7 @@ def main():
             logger.warn("User %s shell %s != /sbin/nologin", _username, _shell)
             continue
 
-        _account_home = AccountHome(username=_username, config=_account_home_config, options=options)
+        _account_home = AccountHome(username=_username, config=_account_home_config, options=options, fs_limits=fs_limits)
         _slurm_account = SlurmAccount(username=_username, options=options)
 
         if args.report:
@@ -318,21 +470,54 @@ def main():
             _data["SCRATCH"] = _account_home.scratch_exists()
             _data["EXTRA"] = _account_home.extra_directories
             _data["SLURM"] = _slurm_account.exists()
-            if args.report_space:
-                _data["HOME_USED"] = get_space_used(host=_account_home_config["server"], path=_account_home.home)
-                _data["SCRATCH_USED"] = get_space_used(path=_account_home.scratch)
-                _data["EXTRA_USED"] = 0
-                for _dir in _account_home.extra_directories:
-                    _data["EXTRA_USED"] += get_space_used(path=_dir)
+            _data["HOME_PATH"] = _account_home.home
+            _data["SCRATCH_PATH"] = _account_home.scratch
             _report.append(_data)
         else:
-            _account_home.cleanup()
-            _slurm_account.delete()
+            _cleanups.append((_account_home, _slurm_account))
+    if _cleanups:
+        logger.info("Cleaning up %d accounts, %d at a time", len(_cleanups), args.jobs)
+        pool = ThreadPool(processes=max(args.jobs, 1))
+        try:
+            _results = pool.map(cleanup_account, [c[0] for c in _cleanups])
+        finally:
+            pool.close()
+            pool.join()
+        # Delete SLURM users after their directories, a batch of users per sacctmgr command
+        _slurm_results = SlurmAccount.delete_all([c[1] for c in _cleanups], noop=args.noop, batch_size=args.sacctmgr_batch_size)
+        print_cleanup_results([(u, p, _slurm_results.get(u, "")) for u, p in _results])
+    if args.report_space:
+        # Gather usage of every path at once before building the report
+        space_index = SpaceIndex(host=_account_home_config["server"], fs=_account_home_config.get("server_fs", "tank/home"),
+                                 jobs=args.space_jobs, scan_jobs=args.scan_jobs, timeout=args.scan_timeout, scan_all=args.report_files)
+        _space_paths = []
+        for _data in _report:
+            _space_paths += [_data["HOME_PATH"], _data["SCRATCH_PATH"]] + _data["EXTRA"]
+        space_index.build(_space_paths)
+        for _data in _report:
+            _data["HOME_USED"] = space_index.get(_data["HOME_PATH"])
+            _data["SCRATCH_USED"] = space_index.get(_data["SCRATCH_PATH"])
+            _data["EXTRA_USED"] = 0
+            for _dir in _data["EXTRA"]:
+                _data["EXTRA_USED"] = add_used(_data["EXTRA_USED"], space_index.get(_dir))
+            # Files of SCRATCH and extra directories, None unless all were scanned
+            _data["FILES"] = ScanResult(_data["username"])
+            for _dir in [_data["SCRATCH_PATH"]] + _data["EXTRA"]:
+                _scan = space_index.scan(_dir)
+                if _scan is None and os.path.isdir(_dir):
+                    _data["FILES"] = None
+                    break
+                if _scan is not None:
+                    _data["FILES"].merge(_scan)
+    close_executors()
     if args.report:
         if args.report_space:
-            table = prettytable.PrettyTable(["Username", "HOME", "HOME-USED", "SCRATCH", "SCRATCH-USED", "EXTRA", "EXTRA-USED", "SLURM"])
+            _columns = ["Username", "HOME", "HOME-USED", "SCRATCH", "SCRATCH-USED", "EXTRA", "EXTRA-USED", "SLURM"]
+            if args.report_files:
+                _columns += ["FILES", "NEWEST-FILE"]
         else:
-            table = prettytable.PrettyTable(["Username", "HOME", "SCRATCH", "EXTRA", "SLURM"])
+            _columns = ["Username", "HOME", "SCRATCH", "EXTRA", "SLURM"]
+        table = prettytable.PrettyTable(_columns)
         table.hrules = prettytable.FRAME
         _home_total = 0
         _home_used_total = 0
@@ -341,6 +526,7 @@ def main():
         _extra_total = 0
         _extra_used_total = 0
         _slurm_total = 0
+        _files_total = 0
         for r in sorted(_report, key=lambda k: k["username"]):
             _home = r["HOME"]
             _scratch = r["SCRATCH"]
@@ -355,18 +541,29 @@ def main():
             if _slurm:
                 _slurm_total += 1
             if args.report_space:
-                _home_used = bytes2human(r["HOME_USED"])
-                _home_used_total += r["HOME_USED"]
-                _scratch_used = bytes2human(r["SCRATCH_USED"])
-                _scratch_used_total += r["SCRATCH_USED"]
-                _extra_used = bytes2human(r["EXTRA_USED"])
-                _extra_used_total += r["EXTRA_USED"]
-                table.add_row([r["username"], _home, _home_used, _scratch, _scratch_used, "\n".join(_extra), _extra_used, _slurm])
+                # Totals only count space that could be measured
+                _home_used = used2human(r["HOME_USED"])
+                _home_used_total += r["HOME_USED"] or 0
+                _scratch_used = used2human(r["SCRATCH_USED"])
+                _scratch_used_total += r["SCRATCH_USED"] or 0
+                _extra_used = used2human(r["EXTRA_USED"])
+                _extra_used_total += r["EXTRA_USED"] or 0
+                _row = [r["username"], _home, _home_used, _scratch, _scratch_used, "\n".join(_extra), _extra_used, _slurm]
+                if args.report_files:
+                    if r["FILES"] is None:
+                        _row += ["unknown", "unknown"]
+                    else:
+                        _files_total += r["FILES"].files
+                        _row += [r["FILES"].files, format_mtime(r["FILES"].newest_mtime)]
+                table.add_row(_row)
             else:
                 table.add_row([r["username"], _home, _scratch, "\n".join(_extra), _slurm])
         if args.report_space:
-            table.add_row(["", "", "", "", "", "", "", ""])
-            table.add_row(["Total", _home_total, bytes2human(_home_used_total), _scratch_total, bytes2human(_scratch_used_total), _extra_total, bytes2human(_extra_used_total), _slurm_total])
+            _total = ["Total", _home_total, bytes2human(_home_used_total), _scratch_total, bytes2human(_scratch_used_total), _extra_total, bytes2human(_extra_used_total), _slurm_total]
+            if args.report_files:
+                _total += [_files_total, ""]
+            table.add_row([""] * len(_columns))
+            table.add_row(_total)
         else:
             table.add_row(["", "", "", "", ""])
             table.add_row(["Total", _home_total, _scratch_total, _extra_total, _slurm_total])
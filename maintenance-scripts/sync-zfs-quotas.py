@@ -5,7 +5,8 @@ import logging
 import pprint
 import subprocess
 import argparse
-from sh import zfs
+from multiprocessing.pool import ThreadPool
+import prettytable
 
 BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 sys.path.append(BASE_DIR)
@@ -13,6 +14,8 @@ from lib.config import load_config
 from lib.logs import setup_logging
 from lib.local_ldap import LocalLdap, LdapUser, LdapGroup
 from lib.byte_converter import human2bytes, bytes2human
+from lib.zfs import get_userspace, apply_properties, SetJournal, SET_BATCH_SIZE
+from lib.remote import get_executor, close_executors
 
 logger = logging.getLogger()
 
@@ -33,6 +36,10 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--debug', help="set debug level (0-4)", dest="debug", nargs="?", const=0, type=int)
     parser.add_argument('--noop', help="only print actions, make no changes", dest="noop", action="store_true", default=False)
+    parser.add_argument('--jobs', help="number of concurrent zfs commands, for both reading filesystems and setting quotas", dest="jobs", type=int, default=4)
+    parser.add_argument('--batch-size', help="number of quotas set by each zfs set command", dest="batch_size", type=int, default=SET_BATCH_SIZE)
+    parser.add_argument('--journal', help="JSON lines file the result of every quota change is appended to", dest="journal", default=None)
+    parser.add_argument('--host', help="run zfs commands over SSH on this host instead of locally", dest="host", default=None)
     parser.add_argument('--config-env', help="config environment", dest="config_env", default="production")
     args = parser.parse_args()
 
@@ -46,6 +53,34 @@ def print_data(msg, user):
     print "%s - user=%s, uid=%s, email=%s, used=%s, current-quota=%s, ldap-quota=%s" \
         % (msg, user["username"], user["uid"], user["mail"], bytes2human(user["zfs_used"]), _zfs_quota, bytes2human(user["ldap_quota"]))
 
+def check_filesystem(task):
+    """Compare the LDAP quotas of one filesystem's users to its zfs userspace"""
+    zfs_fs, users, remote = task
+    userspace = get_userspace(zfs_fs, remote=remote)
+    logger.debug("Found %d users in zfs userspace of %s", len(userspace), zfs_fs)
+    results = {
+        "over_quota": [],
+        "over_ldap_quota": [],
+        "over_zfs_quota": [],
+        "ldap_quota_mismatch": [],
+    }
+    for _user_data in users:
+        current_used, current_quota = userspace.get(_user_data["username"], _user_data["uid"])
+        _ldap_quota = _user_data["ldap_quota"]
+        _user_data["zfs_quota"] = current_quota
+        _user_data["zfs_used"] = current_used
+
+        if current_used >= _ldap_quota and current_used >= current_quota:
+            results["over_quota"].append(_user_data)
+        elif current_used and current_used >= _ldap_quota:
+            results["over_ldap_quota"].append(_user_data)
+        elif current_used and current_used >= current_quota:
+            results["over_zfs_quota"].append(_user_data)
+
+        if _ldap_quota != current_quota:
+            results["ldap_quota_mismatch"].append(_user_data)
+    return zfs_fs, results
+
 def main():
     args = parse_args()
     config = load_config()
@@ -65,11 +100,8 @@ def main():
     local_ldap = LocalLdap(url=_ldap_url[0], use_tls=_use_tls, bind_dn=_bind_dn, bind_pass=_bind_pass, log_level=None)
     ldap_users = local_ldap.paged_search(base=search_base, sfilter=search_filter, attrlist=search_return_attribs, scope=search_scope)
 
-    users_over_quota = []
-    users_over_ldap_quota = []
-    users_over_zfs_quota = []
-    users_ldap_quota_mismatch = []
-    zfs_set_cmds = []
+    # LDAP users grouped by the filesystem of their quota mount point
+    fs_users = {}
 
     for user in ldap_users:
         _user_data = {}
@@ -91,73 +123,68 @@ def main():
         _ldap_quota = int(hardlimit) * 1024
         zfs_fs = "tank%s" % mount
 
-        # Get current ZFS quota
-        userquota_args = ["get", "-H", "-p", "-o", "value", "userquota@%s" % _username, zfs_fs]
-        logger.debug("Executing: zfs %s", " ".join(userquota_args))
-        userquota_output = zfs(userquota_args)
-        _userquota = userquota_output.strip()
-        if _userquota != "-":
-            current_quota = int(_userquota)
-        else:
-            current_quota = 0
-
-        # Get current used space
-        userused_args = ["get", "-H", "-p", "-o", "value", "userused@%s" % _username, zfs_fs]
-        logger.debug("Executing: zfs %s", " ".join(userused_args))
-        userused_output = zfs(userused_args)
-        _userused = userused_output.strip()
-        if _userused != "-":
-            current_used = int(_userused)
-        else:
-            current_used = 0
-
         _user_data["username"] = _username
         _user_data["uid"] = _uid
         _user_data["mail"] = _mail
         _user_data["zfs_fs"] = zfs_fs
         _user_data["ldap_quota"] = _ldap_quota
-        _user_data["zfs_quota"] = current_quota
-        _user_data["zfs_used"] = current_used
+        fs_users.setdefault(zfs_fs, []).append(_user_data)
 
-        if current_used >= _ldap_quota and current_used >= current_quota:
-            users_over_quota.append(_user_data)
-        elif current_used and current_used >= _ldap_quota:
-            users_over_ldap_quota.append(_user_data)
-        elif current_used and current_used >= current_quota:
-            users_over_zfs_quota.append(_user_data)
+    remote = None
+    if args.host:
+        remote = get_executor(args.host)
 
-        if _ldap_quota != current_quota:
-            users_ldap_quota_mismatch.append(_user_data)
-            zfs_set_cmd = [
-                "set", "userquota@%s=%s" % (_username, _ldap_quota), zfs_fs
-            ]
-            zfs_set_cmds.append(zfs_set_cmd)
-
-    for user in users_over_quota:
-        print_data("WARNING: over quota", user)
+    # Read each filesystem's userspace once, several filesystems at a time
+    pool = ThreadPool(processes=max(args.jobs, 1))
+    try:
+        fs_results = dict(pool.map(check_filesystem, [(f, u, remote) for f, u in sorted(fs_users.items())]))
+    finally:
+        pool.close()
+        pool.join()
+
+    # (filesystem, property) quota changes
+    zfs_set_cmds = []
+    for zfs_fs in sorted(fs_results):
+        for user in fs_results[zfs_fs]["over_quota"]:
+            print_data("WARNING: over quota", user)
     print "---------"
 
-    for user in users_over_ldap_quota:
-        print_data("WARNING: over LDAP quota", user)
+    for zfs_fs in sorted(fs_results):
+        for user in fs_results[zfs_fs]["over_ldap_quota"]:
+            print_data("WARNING: over LDAP quota", user)
     print "---------"
 
-    for user in users_over_zfs_quota:
-        print_data("WARNING: over ZFS quota", user)
+    for zfs_fs in sorted(fs_results):
+        for user in fs_results[zfs_fs]["over_zfs_quota"]:
+            print_data("WARNING: over ZFS quota", user)
     print "---------"
 
-    for user in users_ldap_quota_mismatch:
-        print_data("WARNING: quota does not match LDAP", user)
+    for zfs_fs in sorted(fs_results):
+        for user in fs_results[zfs_fs]["ldap_quota_mismatch"]:
+            print_data("WARNING: quota does not match LDAP", user)
+            zfs_set_cmds.append((zfs_fs, "userquota@%s=%s" % (user["username"], user["ldap_quota"])))
     print "---------"
 
-    for zfs_set_cmd in zfs_set_cmds:
-        logger.debug("Executing: zfs %s", " ".join(zfs_set_cmd))
-        if args.noop:
-            pass
-        else:
-            try:
-                zfs_set_output = zfs(zfs_set_cmd)
-            except ErrorReturnCode:
-                logger.error("FAILED to execute zfs set: %s", zfs_set_output)
+    table = prettytable.PrettyTable(["Filesystem", "Users", "Over Quota", "Over LDAP Quota", "Over ZFS Quota", "Quota Mismatch"])
+    for zfs_fs in sorted(fs_results):
+        _results = fs_results[zfs_fs]
+        table.add_row([zfs_fs, len(fs_users[zfs_fs]), len(_results["over_quota"]), len(_results["over_ldap_quota"]),
+                       len(_results["over_zfs_quota"]), len(_results["ldap_quota_mismatch"])])
+    print table
+
+    journal = None
+    if args.journal:
+        journal = SetJournal(args.journal)
+    try:
+        _set, _failed = apply_properties(zfs_set_cmds, jobs=args.jobs, batch_size=args.batch_size, journal=journal, noop=args.noop, remote=remote)
+    finally:
+        if journal:
+            journal.close()
+        close_executors()
+    for _fs, _prop, _error in _failed:
+        logger.error("FAILED to execute zfs set %s %s: %s", _prop, _fs, _error)
+    if not args.noop:
+        logger.info("Set %d ZFS quotas, %d failed", _set, len(_failed))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import argparse
+import os, sys, re
+import random
+import time
+import timeit
+from datetime import datetime, timedelta
+from decimal import Decimal
+import dateutil.parser
+
+BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(BASE_DIR)
+from lib.slurm import slurm_duration_to_sec, _duration_to_sec, slurm_time_to_epoch, cmp_start_end_time, _local_day
+
+def legacy_slurm_duration_to_sec(t, debug=False):
+    # Previous regex + Decimal implementation, kept as the baseline
+    m = re.search(r"(([\d]+)?-)?([\d]+)?:?([\d]{2})\:([\d\.]+)", t)
+    sec = Decimal('0.0')
+    if not m:
+        return sec
+    if m.group(2):
+        sec += Decimal('86400.0') * Decimal(m.group(2))
+    if m.group(3):
+        sec += Decimal('3600.0') * Decimal(m.group(3))
+    sec += Decimal('60.0') * Decimal(m.group(4))
+    sec += Decimal(m.group(5))
+    return int(round(sec, 0))
+
+def sample_durations(count, distinct):
+    # Mimic sacct elapsed values: a few very common short runtimes and
+    # walltime limits mixed with a long tail of distinct values
+    common = ["00:00:00", "00:00:01", "00:00:02", "01:00:00", "2-00:00:00", "7-00:00:00"]
+    tail = []
+    for i in xrange(distinct):
+        _sec = random.randint(0, 14 * 86400)
+        _days, _rem = divmod(_sec, 86400)
+        _clock = "%02d:%02d:%02d" % (_rem // 3600, (_rem % 3600) // 60, _rem % 60)
+        tail.append("%d-%s" % (_days, _clock) if _days else _clock)
+    tail += ["10:30", "59:59.5", "00:01.499", "Unknown"]
+    return [random.choice(common) if random.random() < 0.5 else random.choice(tail) for i in xrange(count)]
+
+def legacy_slurm_time_to_epoch(t):
+    # Previous dateutil implementation, local time like sacct prints
+    return int(dateutil.parser.parse(t).strftime("%s"))
+
+def sample_times(count):
+    # Every half hour of 2024 in random order, which includes both DST changes
+    _start = datetime(2024, 1, 1)
+    times = [(_start + timedelta(minutes=30 * i)).strftime("%Y-%m-%dT%H:%M:%S") for i in xrange(366 * 48)]
+    times += [(_start + timedelta(seconds=random.randint(0, 366 * 86400))).strftime("%Y-%m-%dT%H:%M:%S") for i in xrange(count)]
+    random.shuffle(times)
+    return times
+
+# Jobs running across the 2024 DST changes in America/Chicago: (start, end, seconds)
+DST_JOBS = [
+    ("2024-03-09T12:00:00", "2024-03-10T12:00:00", 23 * 3600),
+    ("2024-03-10T01:30:00", "2024-03-10T03:30:00", 3600),
+    ("2024-11-02T12:00:00", "2024-11-03T12:00:00", 25 * 3600),
+    ("2024-11-03T00:30:00", "2024-11-03T02:30:00", 3 * 3600),
+]
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--count', help="durations per run", type=int, default=50000)
+    parser.add_argument('--distinct', help="distinct long tail durations", type=int, default=5000)
+    parser.add_argument('--repeat', help="timing runs, best is reported", type=int, default=3)
+    parser.add_argument('--tz', help="timezone sacct timestamps are read in, the DST checks assume America/Chicago", default="America/Chicago")
+    args = parser.parse_args()
+
+    os.environ["TZ"] = args.tz
+    time.tzset()
+
+    random.seed(0)
+    durations = sample_durations(args.count, args.distinct)
+
+    for t in set(durations):
+        if int(legacy_slurm_duration_to_sec(t)) != slurm_duration_to_sec(t):
+            print "ERROR: mismatch for %s: %s != %s" % (t, legacy_slurm_duration_to_sec(t), slurm_duration_to_sec(t))
+            sys.exit(1)
+
+    times = sample_times(args.count)
+    for t in set(times):
+        if legacy_slurm_time_to_epoch(t) != slurm_time_to_epoch(t):
+            print "ERROR: mismatch for %s: %s != %s" % (t, legacy_slurm_time_to_epoch(t), slurm_time_to_epoch(t))
+            sys.exit(1)
+    if args.tz == "America/Chicago":
+        for _start, _end, _sec in DST_JOBS:
+            if cmp_start_end_time(_start, _end) != _sec:
+                print "ERROR: run time from %s to %s is %s, expected %s" % (_start, _end, cmp_start_end_time(_start, _end), _sec)
+                sys.exit(1)
+
+    def run(func):
+        return min(timeit.repeat(lambda: [func(t) for t in durations], number=1, repeat=args.repeat))
+
+    legacy = run(legacy_slurm_duration_to_sec)
+    uncached = run(_duration_to_sec.__wrapped__)
+    _duration_to_sec.cache_clear()
+    cached = run(slurm_duration_to_sec)
+    print "legacy regex+Decimal: %.3fs (%.2f us/call)" % (legacy, legacy / args.count * 1e6)
+    print "integer parse:        %.3fs (%.2f us/call) %.1fx" % (uncached, uncached / args.count * 1e6, legacy / uncached)
+    print "integer parse+cache:  %.3fs (%.2f us/call) %.1fx" % (cached, cached / args.count * 1e6, legacy / cached)
+
+    def run_times(func):
+        return min(timeit.repeat(lambda: [func(t) for t in times], number=1, repeat=args.repeat))
+
+    legacy = run_times(legacy_slurm_time_to_epoch)
+    _local_day.cache_clear()
+    cached = run_times(slurm_time_to_epoch)
+    print "legacy dateutil time: %.3fs (%.2f us/call)" % (legacy, legacy / len(times) * 1e6)
+    print "local midnight+cache: %.3fs (%.2f us/call) %.1fx" % (cached, cached / len(times) * 1e6, legacy / cached)
+
+if __name__ == '__main__':
+    main()
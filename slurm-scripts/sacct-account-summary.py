@@ -1,31 +1,39 @@
 #!/usr/bin/env python
 
 import argparse
-from subprocess import Popen, PIPE
+from subprocess import CalledProcessError
 from datetime import date
 from dateutil.relativedelta import relativedelta
 from calendar import monthrange
-import time
-import dateutil.parser
-import os, sys, re
+import os, sys
 from decimal import Decimal
-import prettytable
 
 BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 sys.path.append(BASE_DIR)
-from lib.slurm import slurm_duration_to_sec
+from lib.slurm import sacct_command, sacct_lines, sacct_file_lines, SacctParser, SacctAggregator, windowed_aggregate, NumpySacctAggregator, \
+    SacctFormatError
+from lib.slurm import CALC_ELAPSED, CALC_START_END, CALC_START_END_SUSPENDED, METRICS, LogHistogram, sec_to_slurm_duration
+from lib.sacct_cache import SacctCache
+from lib.sacct_columnar import SacctColumnWriter, SacctColumns, is_columnar
+from lib.sacct_rollup import RollupStore
+from lib.config import load_config
+from lib.report import report_writer, FORMATS
 
-def cmp_start_end_time(start, end, debug=False):
-    _start = dateutil.parser.parse(start).strftime("%s")
-    _end = dateutil.parser.parse(end).strftime("%s")
-    _sec = int(_end) - int(_start)
-    return _sec
-
-def cmp_start_end_suspended_time(start, end, suspend, debug=False):
-    _end_start_sec = cmp_start_end_time(start=start, end=end, debug=debug)
-    _suspend = slurm_time_to_sec(t=suspend, debug=debug)
-    _sec = int(_end_start_sec) - int(_suspend)
-    return _sec
+SACCT_FORMAT = "user,account,elapsed,ncpus,start,end,suspended"
+# Optional reports by another grouping: (argument dest, group_by name, sacct field, column heading)
+GROUP_REPORTS = [
+    ("by_partition", "partition", "partition", "Partition"),
+    ("by_qos", "qos", "qos", "QOS"),
+    ("by_nodes", "nnodes", "nnodes", "Nodes"),
+    ("by_day", "day", "end", "Day"),
+]
+# Optional columns added to every report: (argument dest, METRICS name, column heading, Usage property)
+METRIC_REPORTS = [
+    ("gpu", "gpu", "GPU Hours", "gpu_hours"),
+    ("mem", "mem", "Memory GB Hours", "mem_gb_hours"),
+    ("wait", "wait", "Avg Wait Hours", "avg_wait_hours"),
+]
+PERCENTILES = [50, 95, 99]
 
 TODAY = date.today()
 LAST_MONTH = TODAY - relativedelta(months=1)
@@ -39,107 +47,249 @@ parser.add_argument('--start', help="sacct starttime", default=DEFAULT_STARTTIME
 parser.add_argument('--end', help="sacct endtime", default=DEFAULT_ENDTIME)
 parser.add_argument('--calc2', help="calculate using end-start times", action="store_true", default=False)
 parser.add_argument('--calc3', help="calculate using end-start times minus suspended time", action="store_true", default=False)
-parser.add_argument('--file', help='read sacct output from file instead of command', default=None)
+parser.add_argument('--by-partition', help="also report usage per partition", dest="by_partition", action="store_true", default=False)
+parser.add_argument('--by-qos', help="also report usage per QOS", dest="by_qos", action="store_true", default=False)
+parser.add_argument('--by-nodes', help="also report usage per job node count", dest="by_nodes", action="store_true", default=False)
+parser.add_argument('--by-day', help="also report usage per day jobs ended", dest="by_day", action="store_true", default=False)
+parser.add_argument('--gpu', help="add GPU hours from AllocTRES to reports", action="store_true", default=False)
+parser.add_argument('--mem', help="add memory GB hours from AllocTRES to reports", action="store_true", default=False)
+parser.add_argument('--wait', help="add average hours from submit to start to reports", action="store_true", default=False)
+parser.add_argument('--top', help="report the N largest jobs by CPU hours of each account", type=int, default=0)
+parser.add_argument('--percentiles', help="report approximate p50/p95/p99 job runtime and cores of each account", action="store_true", default=False)
+parser.add_argument('--backend', help="aggregation backend, numpy requires NumPy", choices=["python", "numpy"], default="python")
+parser.add_argument('--parallel', help="number of concurrent sacct queries over time windows", type=int, default=None)
+parser.add_argument('--window', help="time window length for --parallel and --cache", choices=["day", "week"], default="day")
+parser.add_argument('--cache', help="serve closed time windows from the on-disk sacct cache", action="store_true", default=False)
+parser.add_argument('--refresh', help="query sacct again for windows already in the cache", action="store_true", default=False)
+parser.add_argument('--rollup', help="answer from the sacct-rollup.py database, whole days by job end time", action="store_true", default=False)
+parser.add_argument('--format', help="report format, table is for reading and the others stream rows for other programs", choices=FORMATS, default="table")
+parser.add_argument('--config-env', help="config environment", dest="config_env", default="production")
+parser.add_argument('--file', help="read sacct output from file, or a --export directory, instead of command.  A file must be sacct --parsable2 --noheader output with --format=%s plus the fields of any other reports requested" % SACCT_FORMAT, default=None)
+parser.add_argument('--export', help="also write the parsed jobs as memory mappable columns to this directory, requires NumPy", default=None)
 parser.add_argument('--debug', help="debug output", action="store_true", default=False)
 args = parser.parse_args()
 
-if args.file:
+# Progress messages must not mix with machine readable output
+if args.format == "table":
+    info = sys.stdout
+else:
+    info = sys.stderr
+
+if args.calc2:
+    calc = CALC_START_END
+elif args.calc3:
+    calc = CALC_START_END_SUSPENDED
+else:
+    calc = CALC_ELAPSED
+
+# All requested reports are collected from a single sacct query
+group_reports = [r for r in GROUP_REPORTS if getattr(args, r[0])]
+metric_reports = [r for r in METRIC_REPORTS if getattr(args, r[0])]
+_fields = SACCT_FORMAT.split(",")
+for _dest, _name, _field, _heading in group_reports:
+    _fields.append(_field)
+for _dest, _name, _heading, _property in metric_reports:
+    _fields += list(METRICS[_name][1])
+if args.top:
+    _fields.append("jobid")
+SACCT_FORMAT = ",".join(sorted(set(_fields), key=_fields.index))
+
+windowed = args.parallel or args.cache
+job_stats = args.top or args.percentiles
+if args.rollup and (windowed or args.file or calc != CALC_ELAPSED or group_reports or metric_reports or job_stats):
+    print "ERROR: --rollup can not be used with --parallel, --cache, --file, --calc2, --calc3 or additional reports"
+    sys.exit(1)
+if windowed and args.file:
+    print "ERROR: --parallel and --cache can not be used with --file"
+    sys.exit(1)
+if args.export and (windowed or args.rollup):
+    print "ERROR: --export can not be used with --parallel, --cache or --rollup"
+    sys.exit(1)
+if windowed and "jobid" not in SACCT_FORMAT.split(","):
+    # JobID is needed to de-duplicate jobs that span time windows
+    SACCT_FORMAT = "jobid," + SACCT_FORMAT
+
+if args.cache or args.rollup:
+    config = load_config()
+
+cache = None
+if args.cache:
+    _cache_config = config[args.config_env].get("sacct_cache", {})
+    if not _cache_config.get("dir"):
+        print "ERROR: sacct_cache dir is not set in config environment %s" % args.config_env
+        sys.exit(1)
+    cache = SacctCache(directory=_cache_config["dir"], max_age=_cache_config.get("max_age"), refresh=args.refresh)
+
+store = None
+if args.rollup:
+    _rollup_config = config[args.config_env].get("sacct_rollup", {})
+    if not _rollup_config.get("path") or not os.path.isfile(_rollup_config["path"]):
+        print "ERROR: sacct_rollup path is not set or does not exist in config environment %s" % args.config_env
+        sys.exit(1)
+    store = RollupStore(_rollup_config["path"])
+
+columns = None
+if args.file and os.path.isdir(args.file):
+    if not is_columnar(args.file):
+        print "ERROR: Directory %s is not a sacct export" % args.file
+        sys.exit(1)
+    if args.export:
+        print "ERROR: --export can not be used with an exported --file"
+        sys.exit(1)
+    try:
+        columns = SacctColumns(args.file)
+    except ImportError as e:
+        print "ERROR: %s" % e
+        sys.exit(1)
+    _missing = [f for f in SACCT_FORMAT.split(",") if f not in columns.fields]
+    if _missing:
+        print "ERROR: Export %s is missing fields %s" % (args.file, ",".join(_missing))
+        sys.exit(1)
+elif args.file:
     if not os.path.isfile(args.file):
         print "ERROR: File %s not found" % args.file
         sys.exit(1)
-    with open(args.file, 'r') as file:
-        out = file.read()
-else:    
-    cmd = [
-        "sacct", "--allusers", "--parsable2", "--noheader", "--allocations", "--clusters", "brazos",
-    ]
-    if args.account:
-        cmd += ["--accounts=%s" % args.account]
-    cmd += [
-        "--format", "user,account,elapsed,ncpus,start,end,suspended",
-        "--state", "CANCELLED,COMPLETED,FAILED,NODE_FAIL,PREEMPTED,TIMEOUT",
-    	"--starttime", args.start,
-    	"--endtime", args.end,
-    ]
+    lines = sacct_file_lines(args.file)
+elif not windowed and not args.rollup:
+    cmd = sacct_command(SACCT_FORMAT, account=args.account, start=args.start, end=args.end)
     cmd_str = " ".join(cmd)
-    print cmd_str
-
-    process = Popen(cmd, stdout=PIPE)
-    out, err = process.communicate()
-
-users = {}
-accounts = {}
-cpu_hours_total = Decimal('0.0')
-num_jobs_total = 0
-for line in out.split(os.linesep):
-    _line =  line.strip()
-    if args.debug: print "_line: %s" % _line
-    if not _line:
-        continue
-    _data = _line.split("|")
-    if args.debug: print "_data: %s" % _data
-    if args.calc2:
-        _elapsed_sec = cmp_start_end_time(start=_data[4], end=_data[5], debug=args.debug)
-    elif args.calc3:
-        _elapsed_sec = cmp_start_end_suspended_time(start=_data[4], end=_data[5], suspend=_data[6], debug=args.debug)
-    else:
-        _elapsed_sec = slurm_duration_to_sec(t=_data[2], debug=args.debug)
-    _username = _data[0]
-    _account_name = _data[1]
-    _hours = Decimal(str(_elapsed_sec)) / Decimal('3600.0')
-    _ncpus = Decimal(_data[3])
-    _cpu_hours = _hours * _ncpus
-    if args.debug: print "H: %f C: %d - CH: %f" % (_hours, _ncpus, _cpu_hours)
-    # Collect user data
-    if _username in users:
-        _user = users[_username]
-        _user['cpu_hours'] += _cpu_hours
-        _user['num_jobs'] += 1
-    else:
-        _user = {}
-        _user['username'] = _username
-        _user['account'] = _account_name
-        _user['cpu_hours'] = _cpu_hours
-        _user['num_jobs'] = 1
-    users[_username] = _user
-    # Collect account data
-    if _account_name in accounts:
-        _account = accounts[_account_name]
-        _account['cpu_hours'] += _cpu_hours
-        _account['num_jobs'] += 1
+    print >> info, cmd_str
+    lines = sacct_lines(cmd)
+
+if args.backend == "numpy" or columns:
+    aggregator_class = NumpySacctAggregator
+else:
+    aggregator_class = SacctAggregator
+try:
+    _group_by = ["user", "account"] + [r[1] for r in group_reports]
+    _metrics = [r[1] for r in metric_reports]
+    _stats_by = ["account"] if job_stats else []
+    aggregator = aggregator_class(SACCT_FORMAT, group_by=_group_by, calc=calc, metrics=_metrics, stats_by=_stats_by, top=args.top, debug=args.debug)
+except ImportError as e:
+    print "ERROR: %s" % e
+    sys.exit(1)
+sacct_parser = SacctParser(SACCT_FORMAT, debug=args.debug)
+writer = None
+if args.export:
+    try:
+        writer = SacctColumnWriter(args.export, sacct_parser.fields)
+    except ImportError as e:
+        print "ERROR: %s" % e
+        sys.exit(1)
+try:
+    if columns:
+        columns.aggregate(aggregator)
+    elif store:
+        print >> info, "Using rollup of jobs ending from %s to %s (last day ingested %s)" % (args.start[:10], args.end[:10], store.last_day())
+        store.aggregate(aggregator, args.start[:10], args.end[:10], account=args.account)
+    elif windowed:
+        print >> info, "Running sacct over %s windows from %s to %s" % (args.window, args.start, args.end)
+        windowed_aggregate(aggregator, args.start, args.end, processes=args.parallel or 1, step=args.window, cache=cache, account=args.account)
+    elif writer:
+        aggregator.update(writer.write(sacct_parser.parse(lines)))
+        writer.close()
+        print >> info, "Exported %d jobs to %s" % (writer.rows, args.export)
     else:
-        _account = {}
-        _account['account'] = _account_name
-        _account['cpu_hours'] = _cpu_hours
-        _account['num_jobs'] = 1
-    accounts[_account_name] = _account
-    # Collect totals
-    cpu_hours_total += _cpu_hours
-    num_jobs_total += 1
-
-table = prettytable.PrettyTable(["Username", "Account", "CPU Hours", "Completed Jobs"])
-table.hrules = prettytable.FRAME
+        aggregator.update(sacct_parser.parse(lines))
+except CalledProcessError as e:
+    print "ERROR: sacct exited with code %s" % e.returncode
+    sys.exit(1)
+except SacctFormatError as e:
+    print "ERROR: %s" % e
+    print "ERROR: sacct output must be --parsable2 --noheader with --format=%s" % SACCT_FORMAT
+    sys.exit(1)
+cpu_hours_total = aggregator.cpu_hours
+
+writer = report_writer(args.format)
+# Metric columns shared by every usage table, (key, heading)
+metric_columns = [(r[3], r[2]) for r in metric_reports]
+
+def metric_values(usage):
+    return [round(getattr(usage, r[3]), 1) for r in metric_reports]
+
+def percent(cpu_hours):
+    if not cpu_hours_total:
+        return 0.0
+    return round((cpu_hours / cpu_hours_total) * Decimal('100.0'), 1)
+
+# percent is only shown inside the CPU Hours cell of the interactive table
+_columns = [("user", "Username"), ("account", "Account"), ("cpu_hours", "CPU Hours"), ("percent", None), ("completed_jobs", "Completed Jobs")]
+writer.start_table("usage", _columns + metric_columns)
 
 # Display user usage
-user_data = users.values()
-for d in sorted(user_data, key=lambda k: k['cpu_hours'], reverse=True):
-    _account = d['account']
-    _cpu_hours = d['cpu_hours']
-    _num_jobs = d['num_jobs']
-    table.add_row([d['username'], _account, str(round(_cpu_hours, 1)), _num_jobs])
+for d in aggregator.sorted("user"):
+    _values = metric_values(d)
+    writer.add_row([d.key, d.record.account, round(d.cpu_hours, 1), None, d.num_jobs] + _values,
+                   display=[d.key, d.record.account, str(round(d.cpu_hours, 1)), d.num_jobs] + [str(v) for v in _values])
 
-table.add_row(['', '', '', ''])
+writer.add_separator()
 
 # Calculate account(s) percent usage and display account(s) usage
-account_data = accounts.values()
-for account in sorted(account_data, key=lambda k: k['cpu_hours'], reverse=True):
-    _cpu_hours = account['cpu_hours']
-    _num_jobs = account['num_jobs']
-    _percent = (_cpu_hours / cpu_hours_total) * Decimal('100.0')
-    _percent = round(_percent, 1)
+for account in aggregator.sorted("account"):
+    _cpu_hours = account.cpu_hours
+    _percent = percent(_cpu_hours)
     _cpu_hours_percent = "%s (%s%%)" % (str(round(_cpu_hours, 1)), str(_percent))
-    table.add_row(['Total', account['account'], _cpu_hours_percent, _num_jobs])
+    _values = metric_values(account)
+    writer.add_row(['Total', account.key, round(_cpu_hours, 1), _percent, account.num_jobs] + _values,
+                   display=['Total', account.key, _cpu_hours_percent, account.num_jobs] + [str(v) for v in _values])
 
 # Display cluster or account total, depending if --account was used
-table.add_row(['Total', '', int(round(cpu_hours_total, 1)), num_jobs_total])
-print table
+_values = metric_values(aggregator)
+writer.add_row(['Total', '', round(cpu_hours_total, 1), None, aggregator.num_jobs] + _values,
+               display=['Total', '', int(round(cpu_hours_total, 1)), aggregator.num_jobs] + [str(v) for v in _values])
+writer.end_table()
+
+# Display one table for each additional grouping
+for _dest, _name, _field, _heading in group_reports:
+    _columns = [(_name, _heading), ("cpu_hours", "CPU Hours"), ("percent", None), ("completed_jobs", "Completed Jobs")]
+    writer.start_table(_name, _columns + metric_columns)
+    if _name == "day":
+        _usages = sorted(aggregator.groups[_name].values(), key=lambda u: u.key)
+    else:
+        _usages = aggregator.sorted(_name)
+    for d in _usages:
+        _percent = percent(d.cpu_hours)
+        _cpu_hours_percent = "%s (%s%%)" % (str(round(d.cpu_hours, 1)), str(_percent))
+        _values = metric_values(d)
+        writer.add_row([d.key, round(d.cpu_hours, 1), _percent, d.num_jobs] + _values,
+                       display=[d.key, _cpu_hours_percent, d.num_jobs] + [str(v) for v in _values])
+    _values = metric_values(aggregator)
+    writer.add_row(['Total', round(cpu_hours_total, 1), None, aggregator.num_jobs] + _values,
+                   display=['Total', int(round(cpu_hours_total, 1)), aggregator.num_jobs] + [str(v) for v in _values])
+    writer.end_table()
+
+# Display the largest jobs of each account
+if args.top:
+    _columns = [("account", "Account"), ("jobid", "JobID"), ("user", "Username"), ("cores", "Cores"), ("elapsed_sec", "Elapsed"), ("cpu_hours", "CPU Hours")]
+    writer.start_table("top_jobs", _columns)
+    for account in aggregator.sorted("account"):
+        for _cpu_sec, _jobid, _elapsed_sec, _ncpus, _record in account.stats.largest():
+            _cpu_hours = round(_cpu_sec / 3600.0, 1)
+            writer.add_row([account.key, _jobid, _record.user, _ncpus, _elapsed_sec, _cpu_hours],
+                           display=[account.key, _jobid, _record.user, _ncpus, sec_to_slurm_duration(_elapsed_sec), str(_cpu_hours)])
+    writer.end_table()
+
+# Display runtime and core count percentiles of each account and overall
+if args.percentiles:
+    _columns = [("account", "Account"), ("completed_jobs", "Completed Jobs")]
+    # Headings marked ~ as the values are approximate, see LogHistogram
+    _columns += [("runtime_p%d_sec" % p, "Runtime ~p%d" % p) for p in PERCENTILES]
+    _columns += [("cores_p%d" % p, "Cores ~p%d" % p) for p in PERCENTILES]
+    writer.start_table("percentiles", _columns)
+    _runtime_total = LogHistogram()
+    _cores_total = LogHistogram()
+
+    def add_percentile_row(name, num_jobs, runtime, cores):
+        _runtimes = [runtime.quantile(p / 100.0) for p in PERCENTILES]
+        _cores = [cores.quantile(p / 100.0) for p in PERCENTILES]
+        _display = [sec_to_slurm_duration(r) if r is not None else '' for r in _runtimes] + [c if c is not None else '' for c in _cores]
+        writer.add_row([name, num_jobs] + _runtimes + _cores, display=[name, num_jobs] + _display)
+
+    for account in aggregator.sorted("account"):
+        add_percentile_row(account.key, account.num_jobs, account.stats.runtime, account.stats.cores)
+        _runtime_total.merge(account.stats.runtime)
+        _cores_total.merge(account.stats.cores)
+    add_percentile_row('Total', aggregator.num_jobs, _runtime_total, _cores_total)
+    writer.end_table()
+
+writer.close()
@@ -1,36 +1,29 @@
 #!/usr/bin/env python
 
 import argparse
-from subprocess import Popen, PIPE
+from subprocess import CalledProcessError
 from datetime import date
 from dateutil.relativedelta import relativedelta
 from calendar import monthrange
-import time
-import dateutil.parser
-import os, sys, re
-from decimal import Decimal
+import os, sys
 
 BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 sys.path.append(BASE_DIR)
-from lib.slurm import slurm_duration_to_sec
+from lib.slurm import sacct_command, sacct_lines, sacct_file_lines, SacctParser, SacctAggregator, windowed_aggregate, NumpySacctAggregator, \
+    SacctFormatError
+from lib.slurm import CALC_ELAPSED, CALC_START_END, CALC_START_END_SUSPENDED
+from lib.sacct_cache import SacctCache
+from lib.sacct_columnar import SacctColumnWriter, SacctColumns, is_columnar
+from lib.config import load_config
+from lib.report import report_writer, FORMATS
 
-def cmp_start_end_time(start, end, debug=False):
-    _start = dateutil.parser.parse(start).strftime("%s")
-    _end = dateutil.parser.parse(end).strftime("%s")
-    _sec = int(_end) - int(_start)
-    return _sec
-
-def cmp_start_end_suspended_time(start, end, suspend, debug=False):
-    _end_start_sec = cmp_start_end_time(start=start, end=end, debug=debug)
-    _suspend = slurm_time_to_sec(t=suspend, debug=debug)
-    _sec = int(_end_start_sec) - int(_suspend)
-    return _sec
+SACCT_FORMAT = "elapsed,ncpus,start,end,suspended"
 
 TODAY = date.today()
 LAST_MONTH = TODAY - relativedelta(months=1)
 LAST_DAY_OF_MONTH=monthrange(LAST_MONTH.year, LAST_MONTH.month)[1]
-DEFAULT_STARTTIME="%s-%s-01T00:00:00" % (LAST_MONTH.year, LAST_MONTH.month)
-DEFAULT_ENDTIME="%s-%s-%sT23:59:59" % (LAST_MONTH.year, LAST_MONTH.month, LAST_DAY_OF_MONTH)
+DEFAULT_STARTTIME="%s-%02d-01T00:00:00" % (LAST_MONTH.year, LAST_MONTH.month)
+DEFAULT_ENDTIME="%s-%02d-%sT23:59:59" % (LAST_MONTH.year, LAST_MONTH.month, LAST_DAY_OF_MONTH)
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--account', help="SLURM account", default=None)
@@ -39,53 +32,115 @@ parser.add_argument('--start', help="sacct starttime", default=DEFAULT_STARTTIME
 parser.add_argument('--end', help="sacct endtime", default=DEFAULT_ENDTIME)
 parser.add_argument('--calc2', help="calculate using end-start times", action="store_true", default=False)
 parser.add_argument('--calc3', help="calculate using end-start times minus suspended time", action="store_true", default=False)
-parser.add_argument('--file', help='read sacct output from file instead of command', default=None)
+parser.add_argument('--parallel', help="number of concurrent sacct queries over time windows", type=int, default=None)
+parser.add_argument('--window', help="time window length for --parallel and --cache", choices=["day", "week"], default="day")
+parser.add_argument('--cache', help="serve closed time windows from the on-disk sacct cache", action="store_true", default=False)
+parser.add_argument('--refresh', help="query sacct again for windows already in the cache", action="store_true", default=False)
+parser.add_argument('--format', help="report format, table is for reading and the others are for other programs", choices=FORMATS, default="table")
+parser.add_argument('--config-env', help="config environment", dest="config_env", default="production")
+parser.add_argument('--file', help="read sacct output from file, or a --export directory, instead of command.  A file must be sacct --parsable2 --noheader output with --format=%s" % SACCT_FORMAT, default=None)
+parser.add_argument('--export', help="also write the parsed jobs as memory mappable columns to this directory, requires NumPy", default=None)
 parser.add_argument('--debug', help="debug output", action="store_true", default=False)
 args = parser.parse_args()
 
-if args.file:
+# Progress messages must not mix with machine readable output
+if args.format == "table":
+    info = sys.stdout
+else:
+    info = sys.stderr
+
+if args.calc2:
+    calc = CALC_START_END
+elif args.calc3:
+    calc = CALC_START_END_SUSPENDED
+else:
+    calc = CALC_ELAPSED
+
+windowed = args.parallel or args.cache
+if windowed and args.file:
+    print "ERROR: --parallel and --cache can not be used with --file"
+    sys.exit(1)
+if args.export and windowed:
+    print "ERROR: --export can not be used with --parallel or --cache"
+    sys.exit(1)
+if windowed:
+    # JobID is needed to de-duplicate jobs that span time windows
+    SACCT_FORMAT = "jobid," + SACCT_FORMAT
+
+cache = None
+if args.cache:
+    config = load_config()
+    _cache_config = config[args.config_env].get("sacct_cache", {})
+    if not _cache_config.get("dir"):
+        print "ERROR: sacct_cache dir is not set in config environment %s" % args.config_env
+        sys.exit(1)
+    cache = SacctCache(directory=_cache_config["dir"], max_age=_cache_config.get("max_age"), refresh=args.refresh)
+
+columns = None
+if args.file and os.path.isdir(args.file):
+    if not is_columnar(args.file):
+        print "ERROR: Directory %s is not a sacct export" % args.file
+        sys.exit(1)
+    if args.export:
+        print "ERROR: --export can not be used with an exported --file"
+        sys.exit(1)
+    try:
+        columns = SacctColumns(args.file)
+    except ImportError as e:
+        print "ERROR: %s" % e
+        sys.exit(1)
+    _missing = [f for f in SACCT_FORMAT.split(",") if f not in columns.fields]
+    if _missing:
+        print "ERROR: Export %s is missing fields %s" % (args.file, ",".join(_missing))
+        sys.exit(1)
+elif args.file:
     if not os.path.isfile(args.file):
         print "ERROR: File %s not found" % args.file
         sys.exit(1)
-    with open(args.file, 'r') as file:
-        out = file.read()
-else:
-    cmd = [	"sacct", "--allusers", "--parsable2", "--noheader", "--allocations", "--clusters", "brazos" ]
-    if args.account:
-        cmd += ["--accounts=%s" % args.account]
-    if args.user:
-        cmd += ["--user=%s" % args.user]
-    cmd += [
-        "--format", "elapsed,ncpus,start,end,suspended",
-        "--state", "CANCELLED,COMPLETED,FAILED,NODE_FAIL,PREEMPTED,TIMEOUT",
-    	"--starttime", args.start,
-    	"--endtime", args.end,
-    ]
+    lines = sacct_file_lines(args.file)
+elif not windowed:
+    cmd = sacct_command(SACCT_FORMAT, account=args.account, user=args.user, start=args.start, end=args.end)
     cmd_str = " ".join(cmd)
-    print cmd_str
-
-cpu_hours = Decimal('0.0')
+    print >> info, cmd_str
+    lines = sacct_lines(cmd)
 
-process = Popen(cmd, stdout=PIPE)
-out, err = process.communicate()
-
-for line in out.split(os.linesep):
-    _line =  line.strip()
-    if args.debug: print "_line: %s" % _line
-    if not _line:
-        continue
-    _data = _line.split("|")
-    if args.debug: print "_data: %s" % _data
-    if args.calc2:
-        _elapsed_sec = cmp_start_end_time(start=_data[2], end=_data[3], debug=args.debug)
-    elif args.calc3:
-        _elapsed_sec = cmp_start_end_suspended_time(start=_data[2], end=_data[3], suspend=_data[4], debug=args.debug)
+sacct_parser = SacctParser(SACCT_FORMAT, debug=args.debug)
+if columns:
+    aggregator = NumpySacctAggregator(SACCT_FORMAT, calc=calc, debug=args.debug)
+else:
+    aggregator = SacctAggregator(SACCT_FORMAT, calc=calc, debug=args.debug)
+writer = None
+if args.export:
+    try:
+        writer = SacctColumnWriter(args.export, sacct_parser.fields)
+    except ImportError as e:
+        print "ERROR: %s" % e
+        sys.exit(1)
+try:
+    if columns:
+        columns.aggregate(aggregator)
+    elif windowed:
+        print >> info, "Running sacct over %s windows from %s to %s" % (args.window, args.start, args.end)
+        windowed_aggregate(aggregator, args.start, args.end, processes=args.parallel or 1, step=args.window, cache=cache, account=args.account, user=args.user)
+    elif writer:
+        aggregator.update(writer.write(sacct_parser.parse(lines)))
+        writer.close()
+        print >> info, "Exported %d jobs to %s" % (writer.rows, args.export)
     else:
-        _elapsed_sec = slurm_duration_to_sec(t=_data[0], debug=args.debug)
-    _hours = Decimal(str(_elapsed_sec)) / Decimal('3600.0')
-    _ncpus = Decimal(_data[1])
-    _cpu_hours = _hours * _ncpus
-    if args.debug: print "H: %f C: %d - CH: %f" % (_hours, _ncpus, _cpu_hours)
-    cpu_hours = cpu_hours + _cpu_hours
+        aggregator.update(sacct_parser.parse(lines))
+except CalledProcessError as e:
+    print "ERROR: sacct exited with code %s" % e.returncode
+    sys.exit(1)
+except SacctFormatError as e:
+    print "ERROR: %s" % e
+    print "ERROR: sacct output must be --parsable2 --noheader with --format=%s" % SACCT_FORMAT
+    sys.exit(1)
 
-print "CPU HOURS: %d" % int(round(cpu_hours, 0))
+if args.format == "table":
+    print "CPU HOURS: %d" % int(round(aggregator.cpu_hours, 0))
+else:
+    writer = report_writer(args.format)
+    writer.start_table("total", [("cpu_hours", "CPU Hours"), ("completed_jobs", "Completed Jobs")])
+    writer.add_row([round(aggregator.cpu_hours, 1), aggregator.num_jobs])
+    writer.end_table()
+    writer.close()
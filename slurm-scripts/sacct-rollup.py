@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import argparse
+from subprocess import CalledProcessError
+from datetime import date, timedelta
+import os, sys
+
+BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(BASE_DIR)
+from lib.config import load_config
+from lib.sacct_rollup import RollupStore, days_between
+
+def ingest(args, store):
+    _start = args.start
+    if not _start:
+        _last_day = store.last_day()
+        if not _last_day:
+            print "ERROR: Nothing ingested yet, use --start for the first day to ingest"
+            sys.exit(1)
+        _start = (date(*map(int, _last_day.split("-"))) + timedelta(days=1)).isoformat()
+    days = days_between(_start, args.end)
+    if not days:
+        print "Up to date, last day ingested %s" % store.last_day()
+        return
+    print "Ingesting %s to %s" % (days[0], days[-1])
+    try:
+        for day, num_rows in store.ingest(days, processes=args.parallel):
+            if args.verbose: print "%s: %d user/account rows" % (day, num_rows)
+    except CalledProcessError as e:
+        print "ERROR: sacct exited with code %s" % e.returncode
+        sys.exit(1)
+    print "Last day ingested %s" % store.last_day()
+
+def status(args, store):
+    first_day, last_day, num_rows, num_jobs = store.stats()
+    print "Rollup database: %s" % store.path
+    print "Days: %s to %s" % (first_day, last_day)
+    print "High-water mark: %s" % store.last_day()
+    print "Rows: %s Jobs: %s" % (num_rows, num_jobs)
+
+YESTERDAY = (date.today() - timedelta(days=1)).isoformat()
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--config-env', help="config environment", dest="config_env", default="production")
+subparsers = parser.add_subparsers(dest='mode')
+parser_ingest = subparsers.add_parser('ingest', help="add days since the last ingest", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser_ingest.add_argument('--start', help="first day to ingest, default is the day after the last one ingested", default=None)
+parser_ingest.add_argument('--end', help="last day to ingest", default=YESTERDAY)
+parser_ingest.add_argument('--parallel', help="number of days to query concurrently", type=int, default=1)
+parser_ingest.add_argument('--verbose', help="print each day ingested", action="store_true", default=False)
+parser_ingest.set_defaults(func=ingest)
+parser_status = subparsers.add_parser('status', help="show what has been ingested")
+parser_status.set_defaults(func=status)
+args = parser.parse_args()
+
+config = load_config()
+_rollup_config = config[args.config_env].get("sacct_rollup", {})
+if not _rollup_config.get("path"):
+    print "ERROR: sacct_rollup path is not set in config environment %s" % args.config_env
+    sys.exit(1)
+store = RollupStore(_rollup_config["path"])
+args.func(args, store)
+store.close()